@@ -29,9 +29,62 @@ import types
 import logging
 import numpy
 import numpy as np
-from time import sleep
+from time import sleep, time
+import threading
+from multiprocessing.pool import ThreadPool
 import qt
 
+# Locks shared by all instruments on the same interface (e.g. GPIB0)
+_bus_locks = {}
+_bus_locks_lock = threading.Lock()
+
+def _bus_lock(address):
+    bus = address.split('::')[0].upper()
+    _bus_locks_lock.acquire()
+    try:
+        return _bus_locks.setdefault(bus, threading.RLock())
+    finally:
+        _bus_locks_lock.release()
+
+class _LockedBus(object):
+    '''
+    Wraps a visa instrument so that every bus transaction holds the
+    lock of its interface. Instruments on the same interface can then
+    be used from several threads, taking turns per transaction.
+    '''
+    def __init__(self, instrument, lock):
+        self.__dict__['_instrument'] = instrument
+        self.__dict__['lock'] = lock
+
+    def __getattr__(self, name):
+        return getattr(self._instrument, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._instrument, name, value)
+
+    def _locked(self, func, *args):
+        self.lock.acquire()
+        try:
+            return func(*args)
+        finally:
+            self.lock.release()
+
+    def write(self, message):
+        return self._locked(self._instrument.write, message)
+
+    def ask(self, message):
+        return self._locked(self._instrument.ask, message)
+
+    def read(self):
+        return self._locked(self._instrument.read)
+
+    def read_raw(self):
+        return self._locked(self._instrument.read_raw)
+
+    @property
+    def stb(self):
+        return self._locked(getattr, self._instrument, 'stb')
+
 class Keithley_2400(Instrument):
     
     def __init__(self, name, address, reset=False):
@@ -46,8 +99,49 @@ class Keithley_2400(Instrument):
             None
         '''
         Instrument.__init__(self, name, tags=['physical'])
-        self._visainstrument = visa.instrument(address)
+        self._address = address
+        self._visainstrument = _LockedBus(visa.instrument(address),
+                                          _bus_lock(address))
         self._trigger_sent = False
+        self._trigger_count = 1
+        # Driver-side copies of the source and sense mode, so that the
+        # mode-dependent accessors do not need to query them every call.
+        self._source_mode_cache = None
+        self._sense_mode_cache = None
+        # numpy dtype of binary readings, None for ASCII transfers
+        self._data_dtype = None
+        # Reading elements in the order the instrument returns them, and
+        # the currently selected subset (FORM:ELEM) with column indices.
+        self._all_elements = ('VOLT', 'CURR', 'RES', 'TIME', 'STAT')
+        self._elements = self._all_elements
+        # Selection made by the user; functions that need more elements
+        # extend it per call, see _require_elements.
+        self._user_elements = self._all_elements
+        self._element_index = dict((e, i) for i, e in enumerate(self._elements))
+        # Structured array layout of readings, and host time at which the
+        # instrument timestamp was last reset.
+        self._record_fields = {'VOLT':'voltage', 'CURR':'current',
+            'RES':'resistance', 'TIME':'time', 'STAT':'status'}
+        self._record_dtype = numpy.dtype([('voltage', 'f8'), ('current', 'f8'),
+            ('resistance', 'f8'), ('time', 'f8'), ('status', 'u4')])
+        self._timestamp_zero = None
+        # Status word of the last reading and compliance check policy
+        self._last_status = 0
+        self._compliance_check = 1
+        self._line_frequency = None
+        # Parameters whose cached value becomes stale when a parameter is
+        # set, and the set of stale parameters to re-read on next access.
+        self._dependencies = {
+            'source_mode': ('source_value', 'source_range',
+                'source_compliance', 'compliance_tripped'),
+            'sense_mode': ('sense_range', 'nplc', 'autorange', 'sense_value'),
+            'output': ('sense_value', 'compliance_tripped'),
+            'source_value': ('sense_value', 'compliance_tripped'),
+            'source_compliance': ('compliance_tripped', 'sense_range'),
+            'sense_range': ('autorange', 'sense_value'),
+            'autorange': ('sense_range',),
+            }
+        self._dirty = set()
         
         self.add_parameter('source_mode', flags=Instrument.FLAG_GETSET, 
             type=types.IntType, format_map={0:'VOLT', 1:'CURR'})
@@ -101,14 +195,39 @@ class Keithley_2400(Instrument):
         self.add_parameter('compliance_tripped', flags=Instrument.FLAG_GET,
             type=types.BooleanType,
             doc='''Indicates whether Keithley is in compliance.''')    
+        self.add_parameter('over_range', flags=Instrument.FLAG_GET,
+            type=types.BooleanType,
+            doc='''Indicates whether the last reading was over range.''')
+        self.add_parameter('compliance_check', flags=Instrument.FLAG_GETSET,
+            type=types.IntType,
+            format_map={0:'deferred', 1:'on set'},
+            doc='''Check compliance after each source change, or defer
+            it to the status of the next reading.''')
         self.add_parameter('source_rate', flags=Instrument.FLAG_GETSET,
             type = types.FloatType,
             units = 'V/s',
             format = '%.2e',
             doc = '''Sweep rate of the source parameter.''',
             minval=1e-9, maxval=10)
+        self.add_parameter('offset_compensation', flags=Instrument.FLAG_GETSET,
+            type=types.IntType, format_map={0:'off', 1:'on'},
+            doc='''Offset-compensated ohms, each resistance reading is
+            the difference of a reading with source on and off.''')
+        self.add_parameter('four_wire', flags=Instrument.FLAG_GETSET,
+            type=types.IntType, format_map={0:'off', 1:'on'},
+            doc='''Remote (4-wire) sensing.''')
+        self.add_parameter('data_format', flags=Instrument.FLAG_GETSET,
+            type=types.IntType,
+            format_map={0:'ASCII', 1:'SREAL', 2:'REAL,64'},
+            doc='''Transfer format of readings, binary formats are
+            decoded directly into numpy arrays.''')
+        self.add_parameter('reading_elements', flags=Instrument.FLAG_GETSET,
+            type=types.StringType,
+            doc='''Comma separated elements returned per reading, any
+            of VOLT, CURR, RES, TIME, STAT.''')
 
         self.set_parameter_rate('source_value', 5e-5, 50)
+        self._build_command_tables()
         
         self._visainstrument.write('SENS:FUNC:CONC 0')
         
@@ -121,6 +240,21 @@ class Keithley_2400(Instrument):
         self.add_function('set_defaults')
         self.add_function('send_trigger')
         self.add_function('fetch')
+        self.add_function('get_address')
+        self.add_function('measurement_done')
+        self.add_function('wait_for_measurement')
+        self.add_function('invalidate_mode_cache')
+        self.add_function('refresh')
+        self.add_function('sweep_iv')
+        self.add_function('stream_readings')
+        self.add_function('ramp_source_value')
+        self.add_function('measure_statistics')
+        self.add_function('measure_adaptive')
+        self.add_function('measure_delta')
+        self.add_function('get_readings')
+        self.add_function('reset_timestamp')
+        self.add_function('learn_range_plan')
+        self.add_function('sweep_resistance')
         
         if reset:
             self.reset()
@@ -143,6 +277,8 @@ class Keithley_2400(Instrument):
         '''
         logging.debug('Resetting instrument')
         self._visainstrument.write('*RST')
+        self.invalidate_mode_cache()
+        self.reset_timestamp()
         self.get_all()
         
     def set_defaults(self):
@@ -171,52 +307,111 @@ class Keithley_2400(Instrument):
 
     def get_all(self):
         '''
-        Reads all relevant parameters from instrument
+        Reads all relevant parameters from instrument. The instrument
+        settings are read with a single compound query.
         Input:
             None
         Output:
             None
         '''
         logging.info('Get all relevant data from device')
-        self.get_source_mode()
-        outp = self.get_output()
-        # self.get_digits()
-        self.get_nplc()
-        # self.get_display()
-#        self.get_autozero()
-        self.get_averaging_mode()
-        self.get_averaging_count()
-        self.get_source_value()
-        if outp == 1:
-            self.get_sense_value()
-            self.get_sense_range()
-            self.get_sense_mode()
-        self.get_autorange()
-        self.get_source_range()
-        self.get_source_compliance()
-        self.get_compliance_tripped()
+        self._get_parameters()
+        self.get_compliance_check()
+        self.get_over_range()
         self.get_source_rate()
+        if self._cached('output') == 1:
+            self.get_sense_value()
         
-    def send_trigger(self):
+    def send_trigger(self, count=1, records=False):
         '''
         Send trigger to Keithley, use when triggering is not continous.
+        Returns immediately; the instrument signals completion in its
+        status byte (and asserts SRQ), see measurement_done() and
+        wait_for_measurement(). Use fetch() to read the result.
+
+        Input:
+            count (int)     : number of readings to take
+            records (bool)  : also read the sense value, time and status,
+                              for fetch(records=True)
+        Output:
+            None
         '''
         logging.debug('Sending trigger')
+        if records:
+            mode = self._fast_sense_mode()
+            self._require_elements((self._sense_modes[mode], 'TIME', 'STAT'))
+        if count != self._trigger_count:
+            self._visainstrument.write(':TRIG:COUN %d' % count)
+            self._trigger_count = count
         self._visainstrument.write('INIT')
+        self._request_completion()
         self._trigger_sent = True
+
+    def measurement_done(self):
+        '''
+        Check whether the triggered measurement has finished, with a
+        serial poll that does not disturb the running acquisition.
+
+        Input:
+            None
+        Output:
+            done (bool)
+        '''
+        return bool(self._visainstrument.stb & 32)
+
+    def wait_for_measurement(self, timeout=None, interval=0.01):
+        '''
+        Wait until the triggered measurement has finished. Keeps qtlab
+        responsive while waiting.
+
+        Input:
+            timeout (float)     : maximum waiting time in seconds
+            interval (float)    : polling interval in seconds
+        Output:
+            False if the timeout was reached, True otherwise
+        '''
+        tstart = time()
+        while not self.measurement_done():
+            if timeout is not None and time() - tstart > timeout:
+                logging.warning('Timeout waiting for measurement')
+                return False
+            qt.msleep(interval)
+        return True
         
-    def fetch(self):
+    def fetch(self, records=False, timeout=None):
         '''
         Get data at this instance, not recommended, use get_readval.
-        Use send_trigger() to trigger the device.
+        Use send_trigger() to trigger the device. Waits for the
+        measurement to finish if needed. If it does not finish within
+        <timeout>, the trigger is reset and None is returned.
         Note that Readval is not updated since this triggers itself.
+
+        Input:
+            records (bool)  : return a structured array, see get_readings()
+            timeout (float) : maximum waiting time in seconds, defaults
+                              to the VISA timeout
         '''
 
         if self._trigger_sent:
             logging.debug('Fetching data')
-            reply = self._visainstrument.ask('FETCH?')
-            reply = reply.split(',')
+            if timeout is None:
+                timeout = self.get_visa_timeout()
+            done = self.wait_for_measurement(timeout)
+            if done:
+                reply = self._ask_values('FETCH?')
+            else:
+                self.reset_trigger()
             self._trigger_sent = False
+            if self._trigger_count != 1:
+                self._visainstrument.write(':TRIG:COUN 1')
+                self._trigger_count = 1
+            if not done:
+                return None
+            if 'STAT' in self._element_index:
+                readings = self._parse_readings(reply)
+                self._update_status(readings[-1, self._element_index['STAT']])
+            if records:
+                return self._to_records(self._parse_readings(reply))
             return reply
         else:
             logging.warning('No trigger sent, use send_trigger')
@@ -246,21 +441,927 @@ class Keithley_2400(Instrument):
         self._visainstrument.write('SOUR:CLE:AUTO OFF')
         self._visainstrument.write('SENS:FUNC:CONC OFF')
 
-    def _fast_sense_mode(self):
-        ans = self._visainstrument.ask('SENS:FUNC?')
+    def sweep_iv(self, start=None, stop=None, points=None, spacing='LIN',
+                 values=None, delay=None, timeout=None):
+        '''
+        Perform a source sweep on the instrument itself and return the
+        complete curve in one transfer. The readings are stored in the
+        trace buffer while sweeping and read out once the sweep is done.
+        The source returns to its fixed level afterwards.
+
+        Input:
+            start (float)       : first source value
+            stop (float)        : last source value
+            points (int)        : number of points (max 2500)
+            spacing (string)    : 'LIN' or 'LOG'
+            values (list)       : explicit source values (max 100), uses
+                                  a list sweep and ignores start/stop/points
+            delay (float)       : source delay per point in seconds, None
+                                  keeps the instrument setting. The source
+                                  delay is restored afterwards.
+            timeout (float)     : maximum waiting time in seconds
+        Output:
+            source (array)      : sourced values
+            sense (array)       : measured values of the sense mode
+            timestamps (array)  : instrument timestamps in seconds
+            or None if the sweep timed out
+        '''
+        if self._cached('output') == 0:
+            print '%s: Not permitted with output off.' % self.get_name()
+            return None
+        if values is None and None in (start, stop, points):
+            logging.error('Sweeps need start, stop and points, or values')
+            return None
+        mode = self._fast_source_mode()
+        modstr = self._source_modes[mode]
+        sense = self._fast_sense_mode()
+        sensestr = self._sense_modes[sense]
+        self._require_elements((modstr, sensestr, 'TIME'))
+
+        if values is not None:
+            values = numpy.asarray(values, dtype=float)
+            points = len(values)
+            if points > 100:
+                logging.error('List sweeps are limited to 100 points')
+                return None
+            vals = ','.join(['%.6e' % v for v in values])
+            self._visainstrument.write('SOUR:LIST:%s %s' % (modstr, vals))
+            self._visainstrument.write('SOUR:%s:MODE LIST' % modstr)
+        else:
+            if points > 2500:
+                logging.error('Sweeps are limited to 2500 points')
+                return None
+            self._visainstrument.write(('SOUR:%s:STAR %.6e;:SOUR:%s:STOP %.6e;'
+                ':SOUR:SWE:POIN %d;:SOUR:SWE:SPAC %s;:SOUR:SWE:RANG BEST')
+                % (modstr, start, modstr, stop, points, spacing))
+            self._visainstrument.write('SOUR:%s:MODE SWE' % modstr)
+        restore = 'SOUR:%s:MODE FIX;:TRIG:COUN 1;:TRAC:FEED:CONT NEVER' % modstr
+        if delay is not None:
+            olddel = self._visainstrument.ask('SOUR:DEL:AUTO?;:SOUR:DEL?').split(';')
+            restore += ';:SOUR:DEL %s;:SOUR:DEL:AUTO %s' % (olddel[1], olddel[0])
+
+        logging.debug('Sweeping %d points' % points)
         try:
-            mode = ans.split(':')[0]
-            mode = mode.strip('"')
+            if delay is not None:
+                self._visainstrument.write('SOUR:DEL %.6e' % delay)
+            self._arm_buffer(points)
+            self._visainstrument.write('INIT')
+            if not self._wait_for_completion(timeout):
+                logging.error('Sweep did not finish, aborted')
+                self._visainstrument.write(':ABOR')
+                return None
+            reply = self._ask_values('TRAC:DATA?')
         except:
-            mode = ans
-        smode = self._key_with_value(self.get_parameter_options('sense_mode')['format_map'], mode)
-        return smode
+            self._visainstrument.write(':ABOR')
+            raise
+        finally:
+            self._visainstrument.write(restore)
+
+        data = self._parse_readings(reply)
+        idx = self._element_index
+        return data[:, idx[modstr]], data[:, idx[sensestr]], data[:, idx['TIME']]
+
+    def stream_readings(self, chunk_size=100, rate=None, chunks=None,
+                        timeout=None, records=False):
+        '''
+        Generator for continuous acquisition, yielding arrays of sense
+        values (or reading records) of <chunk_size> readings each. The next chunk is triggered
+        before the current one is yielded, so the instrument keeps
+        integrating while the data is processed. The acquisition is
+        aborted when the generator is closed or exhausted, or when a
+        chunk does not complete within <timeout>.
+
+        Usage:
+            for values in k.stream_readings(500):
+                ...
+
+        Input:
+            chunk_size (int)    : readings per chunk (max 2500)
+            rate (float)        : readings per second, None for as fast
+                                  as the integration time allows
+            chunks (int)        : number of chunks, None for unlimited
+            timeout (float)     : maximum waiting time per chunk
+            records (bool)      : yield structured arrays with instrument
+                                  timestamps, see get_readings()
+        Output:
+            values (array)      : sense values of one chunk
+        '''
+        if self._cached('output') == 0:
+            print '%s: Not permitted with output off.' % self.get_name()
+            return
+        if chunk_size > 2500:
+            logging.error('Chunks are limited to 2500 readings')
+            return
+        mode = self._fast_sense_mode()
+        modstr = self._sense_modes[mode]
+        if records:
+            self._require_elements((modstr, 'TIME', 'STAT'))
+        else:
+            self._require_elements((modstr, 'STAT'))
+        col = self._element_index[modstr]
+        stat = self._element_index['STAT']
+
+        delay = 0.0
+        if rate is not None:
+            delay = max(0.0, 1.0/rate - self._integration_time())
+        oldtrig = self._visainstrument.ask('ARM:COUN?;:TRIG:DEL?').split(';')
+        self._visainstrument.write(':ARM:COUN 1;:TRIG:COUN %d;:TRIG:DEL %.6e'
+            % (chunk_size, delay))
+
+        logging.debug('Start streaming chunks of %d readings' % chunk_size)
+        n = 0
+        try:
+            self._visainstrument.write('INIT')
+            while chunks is None or n < chunks:
+                if not self._wait_for_completion(timeout):
+                    logging.error('Chunk %d did not finish, stop streaming' % (n + 1))
+                    return
+                reply = self._ask_values('FETCH?')
+                n += 1
+                if chunks is None or n < chunks:
+                    self._visainstrument.write('INIT')
+                readings = self._parse_readings(reply)
+                self._update_status(readings[-1, stat])
+                if records:
+                    yield self._to_records(readings)
+                else:
+                    yield readings[:, col]
+        finally:
+            logging.debug('Stop streaming after %d chunks' % n)
+            self._visainstrument.write(':ABOR;:TRIG:COUN 1;:ARM:COUN %s;:TRIG:DEL %s'
+                % (oldtrig[0], oldtrig[1]))
+
+    def ramp_source_value(self, value, rate=None, timeout=None):
+        '''
+        Ramp the source to a new value using a sweep on the instrument,
+        instead of stepping it from software. The time per step is the
+        step delay of source_value or the integration time, whichever
+        is longer, and the step size follows from source_rate.
+        Returns when the instrument reports the ramp as complete. If the
+        ramp times out or is interrupted, it is aborted and the source
+        is left at the last level reached.
+
+        Note: when a sweep ends or is aborted, the instrument returns the
+        output to the bias level, which is the old source value until the
+        new level is written afterwards. The output therefore jumps back
+        by the ramp amplitude for about one bus transaction. Use
+        set_source_value for devices that must not see such a step.
+
+        Input:
+            value (float)       : source value to ramp to
+            rate (float)        : ramp rate in units/s, defaults to
+                                  source_rate
+            timeout (float)     : maximum waiting time in seconds
+        Output:
+            True, None if the source is in compliance afterwards, or
+            False if the ramp timed out
+        '''
+        if self._cached('output') == 0:
+            print '%s: Not permitted with output off.' % self.get_name()
+            return None
+        mode = self._fast_source_mode()
+        modstr = self._source_modes[mode]
+        old = self._cached('source_value')
+        if rate is None:
+            rate = self.get_source_rate(query=False) or self.get_source_rate()
+        # Every sweep point also integrates a reading, so a point takes
+        # at least the integration time.
+        integration = self._integration_time()
+        dt = max(self.get_parameter_options('source_value')['stepdelay']*1e-3,
+                 integration)
+
+        step = rate*dt
+        points = int(numpy.ceil(abs(value - old)/step)) + 1
+        if points > 2500:
+            points = 2500
+            dt = abs(value - old)/(rate*(points - 1))
+        if points < 2:
+            return self.set_source_value(value)
+        delay = max(0.0, dt - integration)
+
+        logging.debug('Ramp source to %s in %d points' % (value, points))
+        olddel = self._visainstrument.ask('SOUR:DEL:AUTO?;:SOUR:DEL?').split(';')
+        self._visainstrument.write(('SOUR:%s:STAR %.6e;:SOUR:%s:STOP %.6e;'
+            ':SOUR:SWE:POIN %d;:SOUR:SWE:SPAC LIN;:SOUR:SWE:RANG BEST;'
+            ':SOUR:DEL %.6e;:TRIG:COUN %d')
+            % (modstr, old, modstr, value, points, delay, points))
+        self._visainstrument.write('SOUR:%s:MODE SWE' % modstr)
+        # The trace buffer counts the sweep points done, so an aborted
+        # ramp can be left at the last level it reached.
+        self._arm_buffer(points)
+        level = value
+        done = False
+        try:
+            self._visainstrument.write('INIT')
+            done = self._wait_for_completion(timeout)
+        finally:
+            if not done:
+                self._visainstrument.write(':ABOR')
+                n = int(float(self._visainstrument.ask('TRAC:POIN:ACT?')))
+                level = old + (value - old)*max(n - 1, 0)/float(points - 1)
+                logging.warning('Ramp aborted at %s after %d of %d points'
+                    % (level, n, points))
+            # The output returned to the bias (old) level when the sweep
+            # ended; set the fixed level before leaving sweep mode, so
+            # the source goes back to where the sweep ended.
+            self._visainstrument.write('SOUR:%s:LEV:AMPL %6.12f' % (modstr, level))
+            self._visainstrument.write('SOUR:%s:MODE FIX;:TRIG:COUN 1;'
+                ':TRAC:FEED:CONT NEVER;:SOUR:DEL %s;:SOUR:DEL:AUTO %s'
+                % (modstr, olddel[1], olddel[0]))
+            self.update_value('source_value', level)
+            self._mark_dirty('source_value')
+            if not done:
+                self._dirty.add('source_value')
+        if not done:
+            return False
+
+        if self._compliance_check and self.get_compliance_tripped():
+            return None
+        return True
+
+    def measure_statistics(self, n, raw=False, timeout=None):
+        '''
+        Take <n> readings into the trace buffer and let the instrument
+        compute their statistics, so only the statistics are transferred.
+
+        Input:
+            n (int)             : number of readings (2 to 2500)
+            raw (bool)          : also read out the buffered readings
+            timeout (float)     : maximum waiting time in seconds
+        Output:
+            stats (dict)        : 'mean', 'std', 'min', 'max' and 'n' of the
+                                  sense values, and 'raw' if requested,
+                                  or None if the readings timed out
+        '''
+        if self._cached('output') == 0:
+            print '%s: Not permitted with output off.' % self.get_name()
+            return None
+        if n < 2 or n > 2500:
+            logging.error('Statistics need 2 to 2500 readings')
+            return None
+        mode = self._fast_sense_mode()
+        modstr = self._sense_modes[mode]
+        self._require_elements((modstr, 'STAT'))
+        # CALC3 returns one value per measured function in the selection
+        functions = [e for e in self._elements if e in self._sense_modes]
+        col = functions.index(modstr)
+
+        logging.debug('Measuring statistics of %d readings' % n)
+        forms = ('MEAN', 'SDEV', 'MIN', 'MAX')
+        try:
+            self._arm_buffer(n)
+            self._visainstrument.write('INIT')
+            if not self._wait_for_completion(timeout):
+                logging.error('Readings did not finish, aborted')
+                self._visainstrument.write(':ABOR')
+                return None
+            if self._data_dtype is None:
+                query = ';:'.join(['CALC3:FORM %s;:CALC3:DATA?' % f for f in forms])
+                replies = self._visainstrument.ask(query).split(';')
+                values = [numpy.fromstring(r, sep=',') for r in replies]
+            else:
+                values = []
+                for f in forms:
+                    self._visainstrument.write('CALC3:FORM %s' % f)
+                    values.append(self._ask_values('CALC3:DATA?'))
+            if raw:
+                readings = self._parse_readings(self._ask_values('TRAC:DATA?'))
+        finally:
+            self._visainstrument.write(':TRIG:COUN 1;:TRAC:FEED:CONT NEVER')
+
+        stats = {'n': n}
+        for key, val in zip(('mean', 'std', 'min', 'max'), values):
+            stats[key] = float(val[col])
+        if raw:
+            stats['raw'] = readings[:, self._element_index[modstr]]
+            self._update_status(readings[-1, self._element_index['STAT']])
+        return stats
+
+    def measure_adaptive(self, target, nplc_levels=(0.1, 1.0, 10.0), batch=5,
+                         max_readings=50):
+        '''
+        Measure the sense value until its relative standard error is
+        below <target>, using as little integration time as possible.
+        Readings are taken in batches at the lowest nplc level; the noise
+        is estimated from the readings so far, and the nplc is only
+        raised when the predicted number of readings at the current level
+        exceeds <max_readings>. The nplc setting is restored afterwards.
+
+        Input:
+            target (float)      : target relative uncertainty, e.g. 1e-4
+            nplc_levels (tuple) : nplc values to try, in increasing order
+            batch (int)         : readings per trigger (at least 2)
+            max_readings (int)  : readings allowed per nplc level
+        Output:
+            result (dict)       : 'value', 'uncertainty' (standard error),
+                                  'relative', 'n' and 'nplc', or None if
+                                  a reading timed out
+        '''
+        if self._cached('output') == 0:
+            print '%s: Not permitted with output off.' % self.get_name()
+            return None
+        mode = self._fast_sense_mode()
+        modstr = self._sense_modes[mode]
+        self._require_elements((modstr, 'STAT'))
+        col = self._element_index[modstr]
+        batch = max(batch, 2)
+        old_nplc = self._cached('nplc')
+
+        try:
+            for nplc in nplc_levels:
+                self.set_nplc(nplc)
+                values = numpy.array([])
+                while len(values) < max_readings:
+                    self.send_trigger(batch)
+                    reply = self.fetch()
+                    if reply is None:
+                        return None
+                    readings = self._parse_readings(reply)
+                    values = numpy.append(values, readings[:, col])
+                    n = len(values)
+                    mean = values.mean()
+                    std = values.std(ddof=1)
+                    if mean == 0:
+                        rel = numpy.inf
+                    else:
+                        rel = std/numpy.sqrt(n)/abs(mean)
+                    if rel <= target:
+                        break
+                    needed = (std/(target*abs(mean)))**2 if mean != 0 else numpy.inf
+                    if needed > max_readings and nplc != nplc_levels[-1]:
+                        break
+                if rel <= target:
+                    break
+                logging.debug('Relative error %.2e at nplc %s, need %.0f readings'
+                    % (rel, nplc, needed))
+            else:
+                logging.warning('Target uncertainty %.2e not reached, got %.2e'
+                    % (target, rel))
+        finally:
+            self.set_nplc(old_nplc)
+
+        return {'value': mean, 'uncertainty': std/numpy.sqrt(n),
+                'relative': rel, 'n': n, 'nplc': nplc}
+
+    def measure_delta(self, amplitude, cycles=10, delay=None, timeout=None):
+        '''
+        Current reversal (delta) measurement. The source alternates
+        between +amplitude and -amplitude for <cycles> cycles in a list
+        sweep on the instrument, and the buffer is read back in one
+        transfer. Per cycle, the first harmonic (difference) response is
+        free of thermoelectric offsets, the second harmonic (sum) response
+        contains the terms even in the source value (e.g. heating) plus
+        any constant offset.
+
+        Input:
+            amplitude (float)   : source amplitude
+            cycles (int)        : number of +/- cycles (max 50)
+            delay (float)       : source delay per point in seconds, None
+                                  keeps the instrument setting
+            timeout (float)     : maximum waiting time in seconds
+        Output:
+            result (dict)       : 'first' and 'second' harmonic responses
+                                  (mean over cycles), their standard
+                                  errors 'first_err' and 'second_err',
+                                  'R1' = first/amplitude,
+                                  'R2' = second/amplitude**2, and the
+                                  per cycle arrays 'first_cycles',
+                                  'second_cycles' and 'time'
+        '''
+        if cycles > 50:
+            logging.error('Delta measurements are limited to 50 cycles')
+            return None
+        values = numpy.tile([amplitude, -amplitude], cycles)
+        result = self.sweep_iv(values=values, delay=delay, timeout=timeout)
+        if result is None:
+            return None
+        source, sense, timestamps = result
+
+        plus = sense[0::2]
+        minus = sense[1::2]
+        first = (plus - minus)/2.0
+        second = (plus + minus)/2.0
+        if cycles > 1:
+            first_err = first.std(ddof=1)/numpy.sqrt(cycles)
+            second_err = second.std(ddof=1)/numpy.sqrt(cycles)
+        else:
+            first_err = second_err = numpy.nan
+        return {'first': first.mean(), 'first_err': first_err,
+                'second': second.mean(), 'second_err': second_err,
+                'R1': first.mean()/amplitude,
+                'R2': second.mean()/amplitude**2,
+                'first_cycles': first, 'second_cycles': second,
+                'time': timestamps[0::2]}
+
+    def get_readings(self, count=1, timeout=None):
+        '''
+        Take <count> readings and return them as a structured array with
+        fields voltage, current, resistance, time and status. The time is
+        the instrument timestamp in seconds since reset_timestamp(); add
+        the host time of that reset (see reset_timestamp) for absolute
+        times. Quantities not in reading_elements are NaN.
+
+        Input:
+            count (int)         : number of readings (max 2500)
+            timeout (float)     : maximum waiting time in seconds,
+                                  defaults to the VISA timeout
+        Output:
+            records (array)     : numpy structured array of readings,
+                                  None on timeout
+        '''
+        if self._cached('output') == 0:
+            print '%s: Not permitted with output off.' % self.get_name()
+            return None
+        self.send_trigger(count, records=True)
+        return self.fetch(records=True, timeout=timeout)
+
+    def reset_timestamp(self):
+        '''
+        Reset the instrument timestamp to zero.
+
+        Input:
+            None
+        Output:
+            zero (float)        : host time (time.time()) of the reset
+        '''
+        logging.debug('Resetting timestamp')
+        self._visainstrument.write('SYST:TIME:RES')
+        self._timestamp_zero = time()
+        return self._timestamp_zero
+
+    def learn_range_plan(self, values, points=10):
+        '''
+        Coarse pass over a sweep to learn a fixed measurement range for
+        each sweep point. At <points> evenly spaced sweep points the
+        instrument autoranges, and the chosen range is recorded. Every
+        sweep point gets the larger range of the two coarse points around
+        it. In resistance mode the instrument is set to manual ohms and
+        the range of the measured quantity (the one not sourced) is
+        planned.
+
+        Input:
+            values (list)       : source values of the sweep
+            points (int)        : number of coarse points
+        Output:
+            plan (array)        : measurement range per sweep point, for
+                                  use with sweep_resistance()
+        '''
+        if self._cached('output') == 0:
+            print '%s: Not permitted with output off.' % self.get_name()
+            return None
+        values = numpy.asarray(values, dtype=float)
+        meas = self._planned_mode()
+        coarse = numpy.unique(numpy.linspace(0, len(values) - 1,
+            min(points, len(values))).round().astype(int))
+
+        self._visainstrument.write(self._sense_cmd[meas, 'autorange'] % 1)
+        ranges = []
+        for i in coarse:
+            self.set_source_value(values[i])
+            self.get_sense_value()
+            ranges.append(float(self._visainstrument.ask(self._sense_cmd[meas, 'range?'])))
+        self._planned_autorange(meas, 1)
+
+        plan = numpy.empty(len(values))
+        for j in range(len(coarse) - 1):
+            plan[coarse[j]:coarse[j+1] + 1] = max(ranges[j], ranges[j+1])
+        plan[coarse[-1]:] = ranges[-1]
+        return plan
+
+    def sweep_resistance(self, values, plan=None, points=10):
+        '''
+        Sweep the source and measure at each point with autoranging off,
+        using fixed ranges from a range plan. Without a plan, one is
+        learned first with learn_range_plan(); pass the returned plan to
+        later sweeps over the same values to skip that pass. Combine with
+        sense_mode 'RES', offset_compensation and four_wire for
+        offset-compensated 4-wire resistance sweeps. Autoranging stays
+        off afterwards.
+
+        Input:
+            values (list)       : source values of the sweep
+            plan (array)        : measurement range per sweep point
+            points (int)        : coarse points when learning a plan
+        Output:
+            values (array)      : source values
+            readings (array)    : sense values
+            plan (array)        : the range plan used
+        '''
+        if self._cached('output') == 0:
+            print '%s: Not permitted with output off.' % self.get_name()
+            return None
+        values = numpy.asarray(values, dtype=float)
+        if plan is None:
+            plan = self.learn_range_plan(values, points)
+        meas = self._planned_mode()
+
+        self._visainstrument.write(self._sense_cmd[meas, 'autorange'] % 0)
+        readings = numpy.empty(len(values))
+        current = None
+        try:
+            for i, val in enumerate(values):
+                if plan[i] != current:
+                    self._visainstrument.write(self._sense_cmd[meas, 'range'] % plan[i])
+                    current = plan[i]
+                self.set_source_value(val)
+                readings[i] = self.get_sense_value()
+        finally:
+            self._planned_autorange(meas, 0)
+        return values, readings, plan
+
+    def _planned_mode(self):
+        '''
+        Sense mode whose range is planned: the sense mode itself, or in
+        resistance mode the measured quantity that is not sourced. In
+        resistance mode the instrument is switched to manual ohms, since
+        in auto ohms it chooses the source itself.
+        '''
+        mode = self._fast_sense_mode()
+        if self._sense_modes[mode] == 'RES':
+            self._visainstrument.write('SENS:RES:MODE MAN')
+            return int(not self._fast_source_mode())
+        return mode
+
+    def _planned_autorange(self, meas, val):
+        '''
+        Track the autorange state <val> written for the planned mode.
+        '''
+        if meas == self._fast_sense_mode():
+            self.update_value('autorange', val)
+            self._dirty.discard('autorange')
+        self._mark_dirty('autorange')
+
+    def get_address(self):
+        return self._address
+
+    def get_visa_timeout(self):
+        '''
+        Timeout of the VISA bus in seconds.
+        '''
+        return self._visainstrument.timeout
+
+    def invalidate_mode_cache(self):
+        '''
+        Forget the cached source and sense modes. The next access
+        queries them from the instrument again. Use this when the modes
+        were changed outside the driver (e.g. from the front panel).
+
+        Input:
+            None
+        Output:
+            None
+        '''
+        logging.debug('Invalidating mode cache')
+        self._source_mode_cache = None
+        self._sense_mode_cache = None
+
+    def get(self, name, query=True, **kwargs):
+        '''
+        Get parameter <name>, or a list of names. A parameter that
+        became stale by setting other parameters is re-read on its next
+        access, also with query=False (see refresh()), so the cached
+        values stay correct. A query clears the stale mark.
+        '''
+        if type(name) in (types.ListType, types.TupleType):
+            names = set(name)
+        else:
+            names = set([name])
+        if not query and names.intersection(self._dirty) - set(['sense_value']):
+            self.refresh()
+        val = Instrument.get(self, name, query=query, **kwargs)
+        if query:
+            self._dirty.difference_update(names)
+        return val
+
+    def refresh(self):
+        '''
+        Re-read the parameters that became stale by setting other
+        parameters, with one compound query. Readings (sense_value) are
+        not repeated. Stale parameters are also re-read on their next
+        access, so calling this is only needed to update all of them
+        at once.
+
+        Input:
+            None
+        Output:
+            None
+        '''
+        self._dirty.discard('sense_value')
+        if self._dirty:
+            logging.debug('Refreshing %s' % ', '.join(sorted(self._dirty)))
+            self._get_parameters(self._dirty)
+
+    def _mark_dirty(self, name):
+        '''
+        Mark the parameters that depend on <name> as stale.
+        '''
+        todo = list(self._dependencies.get(name, ()))
+        while todo:
+            dep = todo.pop()
+            if dep not in self._dirty and dep != name:
+                self._dirty.add(dep)
+                todo.extend(self._dependencies.get(dep, ()))
+
+    def _cached(self, name):
+        '''
+        Return the cached value of <name>, re-reading the stale
+        parameters first if it is one of them (see get()).
+        '''
+        val = self.get(name, query=False)
+        if val is None:
+            val = self.get(name)
+        return val
+
+    def _fast_sense_mode(self):
+        if self._sense_mode_cache is not None:
+            return self._sense_mode_cache
+        return self._parse_sense_mode(self._visainstrument.ask('SENS:FUNC?'))
     
     def _fast_source_mode(self):
-        ans = self._visainstrument.ask('SOUR:FUNC?')       
-        mode = self._key_with_value(self.get_parameter_options('source_mode')['format_map'], ans)
+        if self._source_mode_cache is not None:
+            return self._source_mode_cache
+        return self._parse_source_mode(self._visainstrument.ask('SOUR:FUNC?'))
+
+    def _get_parameters(self, names=None):
+        '''
+        Read instrument parameters with one compound query and update
+        their values. The source and sense modes are always read along;
+        the mode dependent queries are built from the cached modes and
+        repeated once if the modes turn out to be different.
+
+        Input:
+            names (list)    : parameters to read, None for all
+        Output:
+            None
+        '''
+        smode = self._source_mode_cache
+        sense = self._sense_mode_cache
+        if smode is None:
+            smode = 0
+        if sense is None:
+            sense = 1
+        while True:
+            entries = [e for e in self._compound_queries[smode, sense]
+                       if names is None or e[0] in names]
+            queries = ['SOUR:FUNC?', 'SENS:FUNC?']
+            for name, qs, parser in entries:
+                queries.extend(qs)
+            ans = self._visainstrument.ask(';:'.join(queries)).split(';')
+            modes = (self._parse_source_mode(ans[0]), self._parse_sense_mode(ans[1]))
+            if modes == (smode, sense):
+                break
+            smode, sense = modes
+        self.update_value('source_mode', smode)
+        self.update_value('sense_mode', sense)
+
+        i = 2
+        for name, qs, parser in entries:
+            self.update_value(name, parser(*ans[i:i+len(qs)]))
+            self._dirty.discard(name)
+            i += len(qs)
+        self._dirty.discard('source_mode')
+        self._dirty.discard('sense_mode')
+
+    def _build_command_tables(self):
+        '''
+        Build the lookup tables between modes and their SCPI names, the
+        mode dependent command strings and the compound queries, so the
+        accessors do not need to look them up on every call.
+        '''
+        fmap = self.get_parameter_options('source_mode')['format_map']
+        self._source_modes = tuple([fmap[k] for k in sorted(fmap)])
+        self._source_mode_keys = dict((v, k) for k, v in fmap.items())
+        fmap = self.get_parameter_options('sense_mode')['format_map']
+        self._sense_modes = tuple([fmap[k] for k in sorted(fmap)])
+        self._sense_mode_keys = dict((v, k) for k, v in fmap.items())
+
+        self._source_cmd = {}
+        for mode, sour in enumerate(self._source_modes):
+            comp = self._source_modes[not mode]
+            self._source_cmd[mode, 'level'] = 'SOUR:%s:LEV:AMPL %%6.12f' % sour
+            self._source_cmd[mode, 'level?'] = 'SOUR:%s:LEV:AMPL?' % sour
+            self._source_cmd[mode, 'range'] = 'SOUR:%s:RANG %%.6e' % sour
+            self._source_cmd[mode, 'range?'] = ':SOUR:%s:RANG?' % sour
+            self._source_cmd[mode, 'compliance'] = 'SENS:%s:PROT:LEV %%6.10f' % comp
+            self._source_cmd[mode, 'compliance?'] = 'SENS:%s:PROT:LEV?' % comp
+            self._source_cmd[mode, 'tripped?'] = 'SENS:%s:PROT:TRIP?' % comp
+
+        self._sense_cmd = {}
+        for mode, sens in enumerate(self._sense_modes):
+            self._sense_cmd[mode, 'range'] = 'SENS:%s:RANG:UPP %%.6e' % sens
+            self._sense_cmd[mode, 'range?'] = 'SENS:%s:RANG:UPP?' % sens
+            self._sense_cmd[mode, 'nplc'] = ':SENS:%s:NPLC %%s' % sens
+            self._sense_cmd[mode, 'nplc?'] = ':SENS:%s:NPLC?' % sens
+            self._sense_cmd[mode, 'autorange'] = ':SENS:%s:RANG:AUTO %%i' % sens
+            self._sense_cmd[mode, 'autorange?'] = ':SENS:%s:RANG:AUTO?' % sens
+
+        self._compound_queries = {}
+        for smode in range(len(self._source_modes)):
+            for sense in range(len(self._sense_modes)):
+                self._compound_queries[smode, sense] = tuple(
+                    self._parameter_queries(smode, sense))
+
+    def _parameter_queries(self, smode, sense):
+        '''
+        List of (parameter, queries, parser) for the parameters that can
+        be read in a compound query, for the given source and sense mode.
+        '''
+        sour = self._source_modes[smode]
+        comp = self._source_modes[not smode]
+        sens = self._sense_modes[sense]
+        return [
+            ('output', ('OUTP?',), int),
+            ('nplc', ('SENS:%s:NPLC?' % sens,), float),
+            ('averaging_mode', ('SENS:AVER:STAT?', 'SENS:AVER:TCON?'),
+                self._parse_averaging_mode),
+            ('averaging_count', ('SENS:AVER:COUN?',), lambda a: int(float(a))),
+            ('source_value', ('SOUR:%s:LEV:AMPL?' % sour,), float),
+            ('sense_range', ('SENS:%s:RANG:UPP?' % sens,), float),
+            ('autorange', ('SENS:%s:RANG:AUTO?' % sens,), int),
+            ('source_range', ('SOUR:%s:RANG?' % sour,), float),
+            ('source_compliance', ('SENS:%s:PROT:LEV?' % comp,), float),
+            ('compliance_tripped', ('SENS:%s:PROT:TRIP?' % comp,), int),
+            ('data_format', ('FORM:DATA?', 'FORM:BORD?'), self._parse_data_format),
+            ('reading_elements', ('FORM:ELEM?',), self._parse_reading_elements),
+            ('offset_compensation', ('SENS:RES:OCOM?',), int),
+            ('four_wire', ('SYST:RSEN?',), int),
+            ]
+
+    def _parse_source_mode(self, ans):
+        '''
+        Convert a SOUR:FUNC? reply to a mode and track it.
+        '''
+        mode = self._source_mode_keys[ans]
+        if mode != self._source_mode_cache:
+            self._source_mode_cache = mode
+            self._set_source_units(mode)
+        return mode
+
+    def _parse_sense_mode(self, ans):
+        '''
+        Convert a SENS:FUNC? reply to a mode and track it.
+        '''
+        mode = self._sense_mode_keys[ans.strip('"').split(':')[0]]
+        if mode != self._sense_mode_cache:
+            self._sense_mode_cache = mode
+            self._set_sense_units(mode)
         return mode
+
+    def _parse_averaging_mode(self, stat, tcon):
+        if stat.strip() in ('1', 'ON'):
+            if tcon == 'MOV':
+                return 1
+            elif tcon == 'REP':
+                return 2
+        return 0
+
+    def _parse_data_format(self, ans, bord='SWAP'):
+        '''
+        Convert FORM:DATA? and FORM:BORD? replies to a data format and
+        track it, including the byte order of binary readings.
+        '''
+        if ans.startswith('ASC'):
+            mode = 0
+        elif ans.startswith('SRE') or ans == 'REAL,32':
+            mode = 1
+        else:
+            mode = 2
+        self._set_data_dtype(mode, bord.strip().startswith('SWAP'))
+        return mode
+
+    def _parse_reading_elements(self, ans):
+        '''
+        Convert a FORM:ELEM? reply to an element string and track it.
+        '''
+        elements = tuple([e.strip()[:4] for e in ans.split(',')])
+        elements = tuple([e for e in self._all_elements if e in elements])
+        if elements != self._elements:
+            # Not a selection extended by the driver, so set elsewhere
+            self._user_elements = elements
+        self._elements = elements
+        self._element_index = dict((e, i) for i, e in enumerate(self._elements))
+        return ','.join(self._user_elements)
+
+    def _set_source_units(self, mode):
+        unit = {0:'V',1:'A'}
+        self.set_parameter_options('source_value', units=unit[mode])
+        self.set_parameter_options('source_range', units=unit[mode])
+        self.set_parameter_options('source_rate', units='%s/s' % unit[mode])
+        self.set_parameter_options('source_compliance', units=unit[not mode])
+
+    def _set_sense_units(self, mode):
+        unit={0:'V',1:'A',2:'Ohm'}
+        self.set_parameter_options('sense_value',units=unit[mode])
+        self.set_parameter_options('sense_range',units=unit[mode])
         
+    def _arm_buffer(self, points):
+        '''
+        Clear the trace buffer and arm it and the trigger model for the
+        next <points> readings.
+        '''
+        self._visainstrument.write('TRAC:CLE;:TRAC:POIN %d;:TRAC:FEED SENS;'
+            ':TRAC:FEED:CONT NEXT;:TRIG:COUN %d' % (points, points))
+
+    def _request_completion(self):
+        '''
+        Let the instrument set the event summary bit of the status byte,
+        and assert SRQ, when the running acquisition has finished.
+        '''
+        self._visainstrument.write('*CLS;*ESE 1;*SRE 32;*OPC')
+
+    def _wait_for_completion(self, timeout=None, interval=0.05):
+        '''
+        Wait until a running acquisition (started with INIT) has finished.
+        Returns False if the timeout was reached.
+        '''
+        self._request_completion()
+        return self.wait_for_measurement(timeout, interval)
+
+    def _integration_time(self):
+        '''
+        Integration time per reading in seconds, from the cached nplc
+        and the line frequency.
+        '''
+        if self._line_frequency is None:
+            self._line_frequency = float(self._visainstrument.ask('SYST:LFR?'))
+        nplc = self._cached('nplc') or 1.0
+        return nplc/self._line_frequency
+
+    def _ask_values(self, query):
+        '''
+        Send a data query (READ?, FETCH?, TRAC:DATA?) and return the
+        reply as a float array, decoded according to the data format.
+        '''
+        if self._data_dtype is None:
+            reply = self._visainstrument.ask(query)
+            return numpy.fromstring(reply, sep=',')
+
+        self._visainstrument.lock.acquire()
+        try:
+            self._visainstrument.write(query)
+            raw = self._visainstrument.read_raw()
+        finally:
+            self._visainstrument.lock.release()
+        # Binary blocks start with '#<n><length>', or '#0' when
+        # the block is terminated by the message terminator.
+        ndigits = int(raw[1])
+        if ndigits == 0:
+            data = raw[2:]
+        else:
+            length = int(raw[2:2+ndigits])
+            data = raw[2+ndigits:2+ndigits+length]
+        size = self._data_dtype.itemsize
+        data = data[:len(data) - len(data) % size]
+        return numpy.frombuffer(data, dtype=self._data_dtype).astype(float)
+
+    def _apply_elements(self, elements):
+        '''
+        Select the elements returned per reading. Only writes FORM:ELEM
+        when the selection differs from the one tracked by the driver.
+        '''
+        elements = tuple([e for e in self._all_elements if e in elements])
+        if elements != self._elements:
+            logging.debug('Set reading elements to %s' % (elements,))
+            self._visainstrument.write('FORM:ELEM %s' % ','.join(elements))
+        self._elements = elements
+        self._element_index = dict((e, i) for i, e in enumerate(elements))
+
+    def _require_elements(self, elements):
+        '''
+        Select the user's reading elements extended with <elements>.
+        Elements required by an earlier call are dropped again.
+        '''
+        self._apply_elements(self._user_elements + tuple(elements))
+
+    def _update_status(self, status):
+        '''
+        Update compliance_tripped and over_range from the status word
+        of a reading (bit 3: compliance, bit 0: over range).
+        '''
+        self._last_status = int(status)
+        self._dirty.discard('compliance_tripped')
+        self.update_value('compliance_tripped', bool(self._last_status & 8))
+        self.update_value('over_range', bool(self._last_status & 1))
+
+    def _to_records(self, readings):
+        '''
+        Convert readings (one row per reading) to a structured array.
+        '''
+        records = numpy.empty(len(readings), dtype=self._record_dtype)
+        for field in ('voltage', 'current', 'resistance', 'time'):
+            records[field] = numpy.nan
+        records['status'] = 0
+        for element, i in self._element_index.items():
+            records[self._record_fields[element]] = readings[:, i]
+        return records
+
+    def _parse_readings(self, values):
+        '''
+        Reshape a flat array of values into one row per reading, with
+        columns given by the current element selection.
+        '''
+        return values.reshape(-1, len(self._elements))
+
     def ask(self, string):
         return self._visainstrument.ask(string)
         
@@ -271,7 +1372,9 @@ class Keithley_2400(Instrument):
         '''
         Waits for the next value available and returns it as a float.
         Note that if the reading is triggered manually, a trigger must
-        be send first to avoid a time-out.
+        be send first to avoid a time-out. If STAT is read along (it is
+        with compliance_check deferred), the status word of the reading
+        updates compliance_tripped and over_range.
 
         Input:
             mode : what measurement to perform?
@@ -279,14 +1382,21 @@ class Keithley_2400(Instrument):
         Output:
             value(float) : last triggerd value on input
         '''
-        if self.get_output() == 0:
+        if self._cached('output') == 0:
             print '%s: Not permitted with output off.' % self.get_name()
             return None
         mode=self._fast_sense_mode()
+        modstr = self._sense_modes[mode]
+        if self._compliance_check:
+            self._require_elements((modstr,))
+        else:
+            # Deferred compliance check needs the status of the reading
+            self._require_elements((modstr, 'STAT'))
         try:
-            reply = self._visainstrument.ask('READ?')
-            reply=reply.split(',')   
-            return float(reply[mode])
+            reply = self._ask_values('READ?')
+            if 'STAT' in self._element_index:
+                self._update_status(reply[self._element_index['STAT']])
+            return float(reply[self._element_index[modstr]])
         except:
             return 0.0
         
@@ -299,7 +1409,62 @@ class Keithley_2400(Instrument):
     def do_set_output(self, val):
         logging.debug('Set output state')
         self._visainstrument.write('OUTP %s' % val)
-        self.get_all()
+        self._mark_dirty('output')
+
+    def do_get_data_format(self):
+        logging.debug('Get data format')
+        ans = self._visainstrument.ask('FORM:DATA?;:FORM:BORD?').split(';')
+        return self._parse_data_format(*ans)
+
+    def do_set_data_format(self, mode):
+        '''
+        Set the transfer format of readings. Binary formats are sent with
+        swapped (little endian) byte order.
+
+        Input:
+            mode (int) : 0: ASCII, 1: SREAL (4 bytes), 2: REAL,64 (8 bytes)
+        Output:
+            None
+        '''
+        logging.debug('Set data format to %s' % mode)
+        modstr = self.get_parameter_options('data_format')['format_map'][mode]
+        if mode == 0:
+            self._visainstrument.write('FORM:DATA ASC')
+        else:
+            self._visainstrument.write('FORM:DATA %s;:FORM:BORD SWAP' % modstr)
+        self._set_data_dtype(mode)
+
+    def _set_data_dtype(self, mode, swapped=True):
+        order = '<' if swapped else '>'
+        if mode == 0:
+            self._data_dtype = None
+        elif mode == 1:
+            self._data_dtype = numpy.dtype(order + 'f4')
+        else:
+            self._data_dtype = numpy.dtype(order + 'f8')
+
+    def do_get_reading_elements(self):
+        logging.debug('Get reading elements')
+        return self._parse_reading_elements(self._visainstrument.ask('FORM:ELEM?'))
+
+    def do_set_reading_elements(self, val):
+        '''
+        Set the elements returned per reading.
+
+        Input:
+            val (string) : comma separated list of VOLT, CURR, RES, TIME
+                           and STAT, e.g. 'CURR' or 'VOLT,CURR,TIME'
+        Output:
+            None
+        '''
+        elements = [e.strip().upper() for e in val.split(',')]
+        for e in elements:
+            if e not in self._all_elements:
+                logging.error('invalid reading element %s' % e)
+                return False
+        self._user_elements = tuple([e for e in self._all_elements if e in elements])
+        self._apply_elements(elements)
+        self.update_value('reading_elements', ','.join(self._user_elements))
 
     def do_get_source_value(self):
         '''
@@ -316,9 +1481,7 @@ class Keithley_2400(Instrument):
         logging.debug('Read source value')
         
         mode = self._fast_source_mode()
-        modstr = self.get_parameter_options('source_mode')['format_map'][mode]
-        
-        return float(self._visainstrument.ask('SOUR:%s:LEV:AMPL?' % modstr))
+        return float(self._visainstrument.ask(self._source_cmd[mode, 'level?']))
 
     def do_set_source_value(self, val, mode=None):
         '''
@@ -335,9 +1498,10 @@ class Keithley_2400(Instrument):
         logging.debug('Set source value')
         
         mode = self._fast_source_mode()
-        modstr = self.get_parameter_options('source_mode')['format_map'][mode]
-        
-        self._visainstrument.write('SOUR:%s:LEV:AMPL %6.12f' % (modstr, val))
+        self._visainstrument.write(self._source_cmd[mode, 'level'] % val)
+        self._mark_dirty('source_value')
+        if not self._compliance_check:
+            return True
         if self.get_compliance_tripped():
             return None
         else:
@@ -353,13 +1517,13 @@ class Keithley_2400(Instrument):
         Output:
             None
         '''
-        if self.get_output() == 0:
+        if self._cached('output') == 0:
             print '%s: Not permitted with output off.' % self.get_name()
             return False
         logging.debug('Set range to %s' % val)
         mode = self._fast_sense_mode()
-        modstr = self.get_parameter_options('sense_mode')['format_map'][mode]
-        self._visainstrument.write('SENS:%s:RANG:UPP %d' % (modstr, val))
+        self._visainstrument.write(self._sense_cmd[mode, 'range'] % val)
+        self._mark_dirty('sense_range')
         
     def do_get_sense_range(self):
         '''
@@ -368,25 +1532,23 @@ class Keithley_2400(Instrument):
         Output:
             range (float) : Range in the specified units
         '''
-        if self.get_output() == 0:
+        if self._cached('output') == 0:
             print '%s: Not permitted with output off.' % self.get_name()
             return None
         logging.debug('Get range')
         mode = self._fast_sense_mode()
-        modstr = self.get_parameter_options('sense_mode')['format_map'][mode]
-        ans = self._visainstrument.ask('SENS:%s:RANG:UPP?' % modstr)
+        ans = self._visainstrument.ask(self._sense_cmd[mode, 'range?'])
         return float(ans)
 
     def do_get_source_compliance(self):
         mode = self._fast_source_mode()
-        modstr = self.get_parameter_options('source_mode')['format_map'][not mode]
-        ans = self._visainstrument.ask('SENS:%s:PROT:LEV?' % modstr)
+        ans = self._visainstrument.ask(self._source_cmd[mode, 'compliance?'])
         return float(ans)
         
     def do_set_source_compliance(self, val):
         mode = self._fast_source_mode()
-        modstr = self.get_parameter_options('source_mode')['format_map'][not mode]
-        self._visainstrument.write('SENS:%s:PROT:LEV %6.10f' % (modstr, val))
+        self._visainstrument.write(self._source_cmd[mode, 'compliance'] % val)
+        self._mark_dirty('source_compliance')
         
     def do_set_digits(self, val):
         '''
@@ -426,10 +1588,8 @@ class Keithley_2400(Instrument):
         '''
         logging.debug('Set integration time to %s PLC' % val)
         mode = self._fast_sense_mode()
-        modstr = self.get_parameter_options('sense_mode')['format_map'][mode]
-        command = str(val)
-        if self.get_output()==1:
-            self._visainstrument.write(':SENS:%s:NPLC %s' % (modstr, command))
+        if self._cached('output') == 1:
+            self._visainstrument.write(self._sense_cmd[mode, 'nplc'] % val)
         else:
             logging.debug('Accessing NPLC settings not permitted with output off!')
 
@@ -448,9 +1608,8 @@ class Keithley_2400(Instrument):
         '''
         logging.debug('Read integration time in PLCs')
         mode = self._fast_sense_mode()
-        modstr = self.get_parameter_options('sense_mode')['format_map'][mode]
-        if self.get_output() ==1:
-            ans = self._visainstrument.ask(':SENS:%s:NPLC?' % modstr)
+        if self._cached('output') == 1:
+            ans = self._visainstrument.ask(self._sense_cmd[mode, 'nplc?'])
         else:
             logging.debug('Accessing NPLC settings not permitted with output off!')
             ans = 1.0
@@ -470,7 +1629,6 @@ class Keithley_2400(Instrument):
         '''
 
         logging.debug('Set source mode to %s', mode)
-        unit = {0:'V',1:'A'}
         
         if mode == 1:
             modstr = 'CURR'
@@ -483,14 +1641,14 @@ class Keithley_2400(Instrument):
         else:
             logging.error('invalid source mode %s' % mode)
         
-        self.set_parameter_options('source_value', units=unit[mode])
-        self.set_parameter_options('source_range', units=unit[mode])
-        self.set_parameter_options('source_compliance', minval=minval, maxval=maxval, units=unit[not mode])
-        self.set_parameter_options('source_rate', units='%s/s' % unit[mode])
+        self._set_source_units(mode)
+        self.set_parameter_options('source_compliance', minval=minval, maxval=maxval)
         self._visainstrument.write('SOUR:FUNC %s' % modstr)
-        
-        self.get_source_range()
-        self.get_output()
+        self._source_mode_cache = mode
+        self._mark_dirty('source_mode')
+        # Re-read range, compliance and level of the new mode in one
+        # compound query, so the parameter view stays correct.
+        self.refresh()
 
     def do_get_source_mode(self):
         '''
@@ -503,15 +1661,7 @@ class Keithley_2400(Instrument):
         string = 'SOUR:FUNC?'
         logging.debug('Getting source mode')
         ans = self._visainstrument.ask(string)
-        mode = self._key_with_value(self.get_parameter_options('source_mode')['format_map'], ans)
-        
-        unit = {0:'V',1:'A'}
-        self.set_parameter_options('source_value', units=unit[mode])
-        self.set_parameter_options('source_range', units=unit[mode])
-        self.set_parameter_options('source_rate', units='%s/s' % unit[mode])
-        self.set_parameter_options('source_compliance', units=unit[not mode])
-        
-        return mode
+        return self._parse_source_mode(ans)
 
     def do_set_sense_mode(self, mode):
         '''
@@ -521,19 +1671,19 @@ class Keithley_2400(Instrument):
         Output:
             None
         '''
-        if self.get_output() == 0:
+        if self._cached('output') == 0:
             print '%s: Not permitted with output off.' % self.get_name()
             return None        
         logging.debug('Set sense mode to %s', mode)
         
-        modstr = self.get_parameter_options('sense_mode')['format_map'][mode]
+        modstr = self._sense_modes[mode]
         command = 'SENS:FUNC "%s"' % modstr
         
         self._visainstrument.write(command)
-        unit={0:'V',1:'A',2:'Ohm'}
-        self.set_parameter_options('sense_value',units=unit[mode])
-        self.set_parameter_options('sense_range',units=unit[mode])
-        self.get_sense_range()
+        self._sense_mode_cache = mode
+        self._set_sense_units(mode)
+        self._mark_dirty('sense_mode')
+        self.refresh()
 
     def do_get_sense_mode(self):
         '''
@@ -545,22 +1695,13 @@ class Keithley_2400(Instrument):
         Output:
             mode (string) : Current mode
         '''
-        if self.get_output() == 0:
+        if self._cached('output') == 0:
             print '%s: Not permitted with output off.' % self.get_name()
             return None
         logging.debug('Getting sense mode')
         
         ans = self._visainstrument.ask('SENS:FUNC?')
-        ans = ans.strip('"')
-        try:
-            ans = ans.split(':')[0]
-        except:
-            pass
-        mode = self._key_with_value(self.get_parameter_options('sense_mode')['format_map'], ans)       
-        unit={0:'V',1:'A',2:'Ohm'}
-        self.set_parameter_options('sense_value',units=unit[mode])
-        self.set_parameter_options('sense_range',units=unit[mode])
-        return mode
+        return self._parse_sense_mode(ans)
 
     def do_get_display(self):
         '''
@@ -620,19 +1761,8 @@ class Keithley_2400(Instrument):
             result (boolean)
         '''
         logging.debug('Get averaging')
-        reply = self._visainstrument.ask('SENS:AVER:STAT?')
-        try:
-            status = int(reply)
-        except:
-            pass
-        if status == 1 or status == 'ON':
-            type = self._visainstrument.ask('SENS:AVER:TCON?')
-            if type == 'MOV':
-                return 1
-            elif type == 'REP':
-                return 2
-        else:
-            return 0
+        reply = self._visainstrument.ask('SENS:AVER:STAT?;:SENS:AVER:TCON?')
+        return self._parse_averaging_mode(*reply.split(';'))
 
     def do_set_averaging_count(self, val):
         '''
@@ -673,9 +1803,8 @@ class Keithley_2400(Instrument):
         '''
         logging.debug('Set autorange to %s ' % val)
         mode = self._fast_sense_mode()
-        modstr=self.get_parameter_options('sense_mode')['format_map'][mode]
-        
-        self._visainstrument.write(':SENS:%s:RANG:AUTO %i' % (modstr,val))
+        self._visainstrument.write(self._sense_cmd[mode, 'autorange'] % val)
+        self._mark_dirty('autorange')
         return True
         
     def do_get_autorange(self):
@@ -687,27 +1816,57 @@ class Keithley_2400(Instrument):
         '''
         logging.debug('Get autorange')
         mode = self._fast_sense_mode()
-        modstr=self.get_parameter_options('sense_mode')['format_map'][mode]
-        
-        reply = self._visainstrument.ask(':SENS:%s:RANG:AUTO?' % modstr)
+        reply = self._visainstrument.ask(self._sense_cmd[mode, 'autorange?'])
         return int(reply)
 
     def do_get_source_range(self):
         mode = self._fast_source_mode()
-        modstr = self.get_parameter_options('source_mode')['format_map'][mode]
-        reply = self._visainstrument.ask(':SOUR:%s:RANG?' % modstr)
+        reply = self._visainstrument.ask(self._source_cmd[mode, 'range?'])
         return float(reply)
         
     def do_set_source_range(self, value):
         mode = self._fast_source_mode()
-        modstr = self.get_parameter_options('source_mode')['format_map'][mode]
-        self._visainstrument.write('SOUR:%s:RANG %.6e' % (modstr, value))
+        self._visainstrument.write(self._source_cmd[mode, 'range'] % value)
         return True
 
+    def do_get_offset_compensation(self):
+        logging.debug('Get offset compensation')
+        return int(self._visainstrument.ask('SENS:RES:OCOM?'))
+
+    def do_set_offset_compensation(self, val):
+        logging.debug('Set offset compensation to %s' % val)
+        self._visainstrument.write('SENS:RES:OCOM %d' % val)
+
+    def do_get_four_wire(self):
+        logging.debug('Get remote sensing')
+        return int(self._visainstrument.ask('SYST:RSEN?'))
+
+    def do_set_four_wire(self, val):
+        logging.debug('Set remote sensing to %s' % val)
+        self._visainstrument.write('SYST:RSEN %d' % val)
+
+    def do_get_over_range(self):
+        return bool(self._last_status & 1)
+
+    def do_get_compliance_check(self):
+        return self._compliance_check
+
+    def do_set_compliance_check(self, val):
+        '''
+        Select when compliance is checked.
+
+        Input:
+            val (int) : 0: only from the status of the next reading,
+                        1: query the instrument after each source change
+        Output:
+            None
+        '''
+        self._compliance_check = val
+
     def do_get_compliance_tripped(self):
         mode = self._fast_source_mode()
-        modstr = self.get_parameter_options('source_mode')['format_map'][not mode]
-        ans = self._visainstrument.ask('SENS:%s:PROT:TRIP?' % modstr)
+        ans = self._visainstrument.ask(self._source_cmd[mode, 'tripped?'])
+        self._dirty.discard('compliance_tripped')
         return int(ans)
     
     def do_set_source_rate(self, val):
@@ -850,25 +2009,136 @@ class Keithley_2400(Instrument):
         '''
         logging.debug('Getting trigger source')
         return self._get_func_par('TRIG', 'SOUR')
-        
-        
-# --------------------------------------
-#           Internal Routines
-# --------------------------------------
 
-    def _key_with_value(self, dict, value):
-        ''' 
-        Function to quickly get the keys from dictionary
-        values.
+
+class Keithley_2400_group(object):
+    '''
+    Drives several Keithley_2400 instruments as one, e.g. an injector and
+    a detector. Source changes, triggers and fetches are issued to all
+    instruments concurrently from a thread pool, where instruments on the
+    same interface take turns per bus transaction. All instruments
+    integrate at the same time, so a point takes about as long as the
+    slowest instrument instead of the sum of all.
+
+    The worker threads are stopped by close(), when leaving a with
+    block, or when the group is deleted.
+
+    Usage:
+    with Keithley_2400_group([k1, k2]) as group:
+        group.set_source_values([1e-4, 0.0])
+        values = group.measure()
+    '''
+    def __init__(self, instruments):
+        self._pool = None
+        self._instruments = list(instruments)
+        self._pool = ThreadPool(len(self._instruments))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _map(self, func, args=None):
+        '''
+        Call func(instrument, arg) for all instruments concurrently and
+        return the results in instrument order.
+        '''
+        if args is None:
+            args = [None]*len(self._instruments)
+        def call(i):
+            return func(self._instruments[i], args[i])
+        return self._pool.map(call, range(len(self._instruments)))
+
+    def get_instruments(self):
+        return list(self._instruments)
+
+    def set_source_values(self, values):
+        '''
+        Set the source value of each instrument.
+
         Input:
-            dict (dictionary)   : dict to search
-            value (value)       : value to look for key
-       
+            values (list)   : one source value per instrument
         Output:
-            v (key)             : key belonging to value 
-    
+            results (list)  : return values of set_source_value
+        '''
+        return self._map(lambda ins, val: ins.set_source_value(val), values)
+
+    def send_trigger(self, count=1):
+        '''
+        Trigger <count> readings on all instruments. The sense value,
+        time and status are added to the reading elements, for fetch().
+        '''
+        self._map(lambda ins, arg: ins.send_trigger(count, records=True))
+
+    def wait_for_measurement(self, timeout=None, interval=0.01):
+        '''
+        Wait until all instruments have finished measuring. Keeps qtlab
+        responsive while waiting.
+
+        Input:
+            timeout (float)     : maximum waiting time in seconds
+            interval (float)    : polling interval in seconds
+        Output:
+            False if the timeout was reached, True otherwise
+        '''
+        tstart = time()
+        while not all(self._map(lambda ins, arg: ins.measurement_done())):
+            if timeout is not None and time() - tstart > timeout:
+                logging.warning('Timeout waiting for measurement')
+                return False
+            qt.msleep(interval)
+        return True
+
+    def fetch(self, timeout=None):
+        '''
+        Fetch the triggered readings of all instruments, waiting for
+        them to finish if needed.
+
+        Input:
+            timeout (float) : maximum waiting time in seconds, defaults
+                              to the longest VISA timeout
+        Output:
+            records (list)  : structured array of readings per instrument,
+                              see Keithley_2400.get_readings(), or None
+                              if the timeout was reached on any of them
+        '''
+        if timeout is None:
+            timeout = max([ins.get_visa_timeout() for ins in self._instruments])
+        records = self._map(lambda ins, arg: ins.fetch(records=True, timeout=timeout))
+        if any(rec is None for rec in records):
+            return None
+        return records
+
+    def measure(self, count=1, timeout=None):
+        '''
+        Trigger <count> readings on all instruments, wait for all of them
+        and fetch the sense values.
+
+        Input:
+            count (int)         : readings per instrument
+            timeout (float)     : maximum waiting time in seconds,
+                                  defaults to the longest VISA timeout
+        Output:
+            values (array)      : sense values, one row per instrument,
+                                  None if the timeout was reached
+        '''
+        fields = ('voltage', 'current', 'resistance')
+        self.send_trigger(count)
+        records = self.fetch(timeout)
+        if records is None:
+            return None
+        return numpy.array([rec[fields[ins.get_sense_mode(query=False)]]
+            for ins, rec in zip(self._instruments, records)])
+
+    def close(self):
+        '''
+        Stop the worker threads.
         '''
-        for k, v in dict.iteritems():
-            if v == value:
-                return k
-        return None
\ No newline at end of file
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -29,9 +29,230 @@ import qt
 import numpy as np
 import sys
 import os
-import matplotlib.pyplot as plt
-import pylab
+import errno
+import threading
+from collections import deque
 import matplotlib as mpl
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+class StabilityDetector(object):
+    '''
+    Decides when a temperature has settled, from the samples of the last
+    <window> seconds. The window keeps running sums, so adding a sample and
+    testing for stability take constant time regardless of the window length.
+
+    The temperature is considered stable when the window spans at least
+    <window> seconds, the rms error to the target is smaller than <tolerance>
+    and the slope of a linear fit is smaller than <max_rate>.
+
+    Any object with reset(target), add(t, value), is_stable() and status()
+    can be passed to Lakeshore_350.ramp_temperature instead.
+
+    Usage:
+    detector = StabilityDetector(tolerance=0.01, max_rate=0.001, window=60)
+    '''
+    def __init__(self, tolerance=0.015, max_rate=None, window=60.0):
+        self.tolerance = tolerance
+        if max_rate is None:
+            # Allow a drift of one tolerance per window
+            max_rate = tolerance / window
+        self.max_rate = max_rate
+        self.window = window
+        self.reset(0.0)
+
+    def reset(self, target):
+        self.target = target
+        self._samples = deque()
+        self._t0 = None
+        self._n = 0
+        self._st = 0.0
+        self._stt = 0.0
+        self._sy = 0.0
+        self._syy = 0.0
+        self._sty = 0.0
+
+    def add(self, t, value):
+        if self._t0 is None:
+            self._t0 = t
+        t = t - self._t0
+        self._samples.append((t, value))
+        self._accumulate(t, value, 1)
+        # Drop samples that are no longer needed to span the window
+        while len(self._samples) > 2 and t - self._samples[1][0] >= self.window:
+            old_t, old_value = self._samples.popleft()
+            self._accumulate(old_t, old_value, -1)
+
+    def _accumulate(self, t, y, sign):
+        self._n += sign
+        self._st += sign*t
+        self._stt += sign*t*t
+        self._sy += sign*y
+        self._syy += sign*y*y
+        self._sty += sign*t*y
+
+    def span(self):
+        if self._n < 2:
+            return 0.0
+        return self._samples[-1][0] - self._samples[0][0]
+
+    def error(self):
+        '''
+        Returns the rms deviation from the target over the window.
+        '''
+        if self._n == 0:
+            return float('inf')
+        n, c = float(self._n), self.target
+        ms = self._syy/n - 2*c*self._sy/n + c*c
+        return math.sqrt(max(ms, 0.0))
+
+    def slope(self):
+        '''
+        Returns the slope of a least squares line through the window,
+        in units per second.
+        '''
+        n = float(self._n)
+        denominator = n*self._stt - self._st**2
+        if self._n < 2 or denominator <= 0:
+            return float('inf')
+        return (n*self._sty - self._st*self._sy) / denominator
+
+    def is_stable(self):
+        return (self.span() >= self.window and
+                self.error() < self.tolerance and
+                abs(self.slope()) < self.max_rate)
+
+    def status(self):
+        return 'rms error %.3fK (%.3fK), slope %.2fmK/min (%.2fmK/min)' % (
+            self.error(), self.tolerance,
+            self.slope()*6e4, self.max_rate*6e4)
+
+class RampHandle(object):
+    '''
+    Handle to a temperature ramp started with
+    Lakeshore_350.ramp_temperature_async. The stability of the temperature
+    is monitored in a background thread.
+
+    Usage:
+    ramp = <name>.ramp_temperature_async(20.0)
+    ... do something else ...
+    ramp.wait()
+    '''
+    def __init__(self, ins, value, detector, timestep, timeout, max_points):
+        self.value = value
+        self.stable = None
+        self.settle_time = None
+        self.message = ''
+        self.filename = None
+        self.tstart = time.time()
+        self.times = deque(maxlen=max_points)
+        self.temperatures = deque(maxlen=max_points)
+        self.heaters = deque(maxlen=max_points)
+        self._ins = ins
+        self._detector = detector
+        self._timestep = timestep
+        self._timeout = timeout
+        self._cancel = threading.Event()
+        self._finished = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run,
+                                        args=(self._cancel.wait, False),
+                                        name='%s ramp' % self._ins.get_name())
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self, sleep, verbose=True):
+        '''
+        Monitors the temperature until it is stable, the timeout is reached
+        or the ramp is cancelled. sleep(seconds) is used to wait between
+        samples. If reading the temperature fails, the ramp ends with
+        stable False and the error in message.
+        '''
+        name = self._ins.get_name()
+        detector = self._detector
+        try:
+            try:
+                while not self._cancel.is_set():
+                    t = time.time()
+                    T, heater = self._ins._read_ramp_sample()
+                    self.times.append(t-self.tstart)
+                    self.temperatures.append(T)
+                    self.heaters.append(heater)
+                    detector.add(t, T)
+                    if detector.is_stable():
+                        self.stable = True
+                        self.settle_time = t-self.tstart
+                        self.message = 'stabilized at %2.2fK after %d seconds.' % (T, int(t-self.tstart))
+                        break
+                    if t > (self.tstart+self._timeout):
+                        self.stable = False
+                        self.message = 'after ramp at %2.2fK, current error %.3fK.' % (T, np.abs(self.value - T))
+                        if verbose:
+                            print '\n%s: Ramping for %.1f seconds total. Maximum waiting time achieved. Script operation resumed.' % (name, int(t-self.tstart))
+                        break
+                    if verbose:
+                        print '%s: Awaiting stable Temp. %s.\r' % (name, detector.status()) ,
+                        sys.stdout.flush()
+                    else:
+                        logging.debug('%s: Awaiting stable Temp. %s.' % (name, detector.status()))
+                    sleep(self._timestep)
+                else:
+                    self.stable = False
+                    self.message = 'cancelled after %d seconds.' % int(time.time()-self.tstart)
+            except Exception, e:
+                self.stable = False
+                self.message = 'reading failed after %d seconds: %s.' % (int(time.time()-self.tstart), e)
+                logging.error('%s: %s' % (name, self.message))
+            self._ins._log_ramp(self)
+        finally:
+            self._finished.set()
+
+    def done(self):
+        '''
+        Returns True if the ramp has finished, was cancelled or timed out.
+        '''
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        '''
+        Waits until the ramp has finished, keeping qtlab responsive.
+
+        Input:
+            timeout (float)     :   Maximum time to wait in seconds. Default
+                                    is to wait until the ramp is done.
+
+        Output:
+            stable (bool)       :   True if the temperature stabilized, False if
+                                    the ramp timed out, was cancelled or failed,
+                                    None if it is still running.
+        '''
+        tend = None if timeout is None else time.time() + timeout
+        while not self.done() and (tend is None or time.time() < tend):
+            qt.msleep(0.1)
+        return self.stable
+
+    def progress(self):
+        '''
+        Returns a dict with the elapsed time, the last temperature and the
+        rms error and slope over the stability window.
+        '''
+        T = self.temperatures[-1] if len(self.temperatures) else None
+        return {'elapsed': time.time() - self.tstart,
+                'temperature': T,
+                'error': self._detector.error(),
+                'slope': self._detector.slope(),
+                'done': self.done(),
+                'stable': self.stable}
+
+    def cancel(self):
+        '''
+        Stops monitoring the ramp. The setpoint is left unchanged.
+        '''
+        self._cancel.set()
+        if self._thread is not None:
+            self._thread.join()
 
 class Lakeshore_350(Instrument):
 
@@ -42,6 +263,33 @@ class Lakeshore_350(Instrument):
         self._visa = visa.instrument(self._address)
         self._channels = ('A', 'B')
         self._outputs = ('1', '2')
+        # Order of the inputs in KRDG? 0 and SRDG? 0 replies
+        self._inputs = ('A', 'B', 'C', 'D')
+        # Maximum length of a command message
+        self._max_message = 64
+        # All bus traffic goes through this lock, so the logger thread and
+        # the caller never interleave a query and its reply
+        self._lock = threading.RLock()
+
+        # Background temperature logger
+        self._log_fields = (['temperature' + ch for ch in self._channels] +
+                            ['sensor_resistance' + ch for ch in self._channels] +
+                            ['heater_output' + out for out in self._outputs])
+        self._log_dtype = np.dtype([('time', 'f8')] +
+                                   [(f, 'f8') for f in self._log_fields])
+        self._log_buffer = None
+        self._log_count = 0
+        # Guards the ring buffer only, so history() never waits for the bus
+        self._log_lock = threading.Lock()
+        self._log_thread = None
+        self._log_stop = threading.Event()
+        self._log_interval = 1.0
+        self._max_sample_age = 2.0
+        self._ramp = None
+        # Settling time model, fitted from the ramp log on first use
+        self._ramp_fits = None
+        # Width of a temperature region in the model, in ln(T)
+        self._region_width = 0.2
 
         self.add_parameter('temperature',
             flags=Instrument.FLAG_GET,
@@ -90,9 +338,52 @@ class Lakeshore_350(Instrument):
             channels=self._outputs,
             units='K')
 
+        self.add_parameter('ramp_rate',
+            flags=Instrument.FLAG_GETSET,
+            type=types.FloatType,
+            minval=0.0, maxval=100.0,
+            channels=self._outputs,
+            units='K/min')
+
+        self.add_parameter('ramp_status',
+            flags=Instrument.FLAG_GET,
+            type=types.IntType,
+            format_map={0: 'idle', 1: 'ramping'},
+            channels=self._outputs)
+
+        self.add_parameter('zone_mode',
+            flags=Instrument.FLAG_GETSET,
+            type=types.BooleanType,
+            channels=self._outputs)
+
+        self.add_parameter('log_interval',
+            flags=Instrument.FLAG_GETSET,
+            type=types.FloatType,
+            minval=0.05,
+            units='s')
+
+        self.add_parameter('max_sample_age',
+            flags=Instrument.FLAG_GETSET,
+            type=types.FloatType,
+            minval=0.0,
+            units='s')
+
         self.add_function('local')
         self.add_function('remote')
         self.add_function('ramp_temperature')
+        self.add_function('ramp_temperature_async')
+        self.add_function('plot_ramp')
+        self.add_function('predict_settle_time')
+        self.add_function('order_setpoints')
+        self.add_function('sweep_temperature')
+        self.add_function('bin_sweep')
+        self.add_function('autotune')
+        self.add_function('get_zones')
+        self.add_function('set_zones')
+        self.add_function('tune_zones')
+        self.add_function('start_logger')
+        self.add_function('stop_logger')
+        self.add_function('history')
 
         if reset:
             self.reset()
@@ -104,47 +395,271 @@ class Lakeshore_350(Instrument):
     # ------------------------------------------------------
             
     def reset(self):
-        self._visa.write('*RST')
+        self._write('*RST')
 
     def get_all(self):
-        paramlist = self.get_parameter_names()
-        for parameter in paramlist:
-            command = 'self.get_' + parameter + '()'
-            eval(command)
+        '''
+        Reads all parameters from the controller. Temperatures and sensor
+        resistances of all inputs are read with KRDG? 0 and SRDG? 0, and
+        all queries are joined into as few messages as possible.
+        '''
+        queries = ['KRDG? 0', 'SRDG? 0', 'MODE?']
+        for output in self._outputs:
+            queries.extend(['RANGE? %s' % output, 'HTR? %s' % output,
+                            'SETP? %s' % output, 'PID? %s' % output,
+                            'RAMP? %s' % output, 'RAMPST? %s' % output,
+                            'OUTMODE? %s' % output])
+        ans = self._ask_many(queries)
+
+        temperatures = ans[0].split(',')
+        resistances = ans[1].split(',')
+        for channel in self._channels:
+            i = self._inputs.index(channel)
+            self.update_value('temperature' + channel, float(temperatures[i]))
+            self.update_value('sensor_resistance' + channel, float(resistances[i]))
+        self.update_value('mode', int(ans[2]))
+        for i, output in enumerate(self._outputs):
+            rng, htr, setp, pid, ramp, rampst, outmode = ans[3+7*i:10+7*i]
+            self.update_value('heater_range' + output, int(rng))
+            self.update_value('heater_output' + output, float(htr))
+            self.update_value('setpoint' + output, float(setp))
+            self.update_value('pid' + output, self._parse_pid(pid))
+            self.update_value('ramp_rate' + output, self._parse_ramp(ramp))
+            self.update_value('ramp_status' + output, int(rampst))
+            self.update_value('zone_mode' + output, self._parse_outmode(outmode)[0] == 2)
+        self.get_log_interval()
+        self.get_max_sample_age()
+
+    def _ask_many(self, queries):
+        '''
+        Send queries joined by semicolons, in as few messages as the
+        controller's input buffer allows, and return the list of replies.
+        '''
+        replies = []
+        message = queries[0]
+        for query in queries[1:]:
+            if len(message) + len(query) + 1 > self._max_message:
+                replies.extend(self._ask(message).split(';'))
+                message = query
+            else:
+                message += ';' + query
+        replies.extend(self._ask(message).split(';'))
+        return replies
+
+    def _ask(self, message):
+        self._lock.acquire()
+        try:
+            return self._visa.ask(message)
+        finally:
+            self._lock.release()
+
+    def _write(self, message):
+        self._lock.acquire()
+        try:
+            self._visa.write(message)
+        finally:
+            self._lock.release()
+
+    def start_logger(self, interval=None, size=3600):
+        '''
+        Starts a background thread that samples the temperatures, sensor
+        resistances and heater outputs into a ring buffer. While the logger
+        runs, get_temperature, get_sensor_resistance and get_heater_output
+        return the latest sample if it is not older than max_sample_age.
+
+        Input:
+            interval (float)    :   Time between samples in seconds. Default
+                                    is the log_interval parameter.
+            size (int)          :   Number of samples kept in the buffer.
+
+        Output:
+            None
+        '''
+        self.stop_logger()
+        if interval is not None:
+            self.set_log_interval(interval)
+        self._log_lock.acquire()
+        try:
+            self._log_buffer = np.zeros(int(size), dtype=self._log_dtype)
+            self._log_count = 0
+        finally:
+            self._log_lock.release()
+        self._log_stop.clear()
+        self._log_thread = threading.Thread(target=self._log_loop,
+                                            name='%s logger' % self.get_name())
+        self._log_thread.daemon = True
+        self._log_thread.start()
+
+    def stop_logger(self):
+        '''
+        Stops the background logger. The buffer is kept, so history() still
+        returns the samples taken so far.
+        '''
+        if self._log_thread is None:
+            return
+        self._log_stop.set()
+        self._log_thread.join()
+        self._log_thread = None
+
+    def history(self, seconds=None):
+        '''
+        Returns the samples taken by the logger, oldest first, without any
+        bus traffic.
+
+        Input:
+            seconds (float)     :   Only return samples from the last
+                                    <seconds> seconds. Default is all.
+
+        Output:
+            samples (numpy array) : structured array with fields time,
+                                    temperature<ch>, sensor_resistance<ch>
+                                    and heater_output<out>.
+        '''
+        self._log_lock.acquire()
+        try:
+            if self._log_buffer is None:
+                return np.zeros(0, dtype=self._log_dtype)
+            size = len(self._log_buffer)
+            n = min(self._log_count, size)
+            start = self._log_count - n
+            idx = np.arange(start, start + n) % size
+            samples = self._log_buffer[idx]
+        finally:
+            self._log_lock.release()
+        if seconds is not None:
+            samples = samples[samples['time'] >= time.time() - seconds]
+        return samples
+
+    def _log_loop(self):
+        queries = ['KRDG? 0', 'SRDG? 0'] + ['HTR? %s' % out for out in self._outputs]
+        while not self._log_stop.is_set():
+            tstart = time.time()
+            try:
+                self._store_sample(tstart, self._ask_many(queries))
+            except Exception, e:
+                logging.warning('%s: logger sample failed: %s' % (self.get_name(), e))
+            self._log_stop.wait(max(0.0, self._log_interval - (time.time() - tstart)))
+
+    def _store_sample(self, t, ans):
+        temperatures = ans[0].split(',')
+        resistances = ans[1].split(',')
+        sample = np.zeros((), dtype=self._log_dtype)
+        sample['time'] = t
+        for channel in self._channels:
+            i = self._inputs.index(channel)
+            sample['temperature' + channel] = float(temperatures[i])
+            sample['sensor_resistance' + channel] = float(resistances[i])
+        for i, output in enumerate(self._outputs):
+            sample['heater_output' + output] = float(ans[2+i])
+        self._log_lock.acquire()
+        try:
+            self._log_buffer[self._log_count % len(self._log_buffer)] = sample
+            self._log_count += 1
+        finally:
+            self._log_lock.release()
+
+    def _fresh_sample(self):
+        '''
+        Returns the latest logger sample, or None if the logger is not
+        running or the sample is older than max_sample_age.
+        '''
+        if self._log_thread is None:
+            return None
+        self._log_lock.acquire()
+        try:
+            if self._log_count == 0:
+                return None
+            sample = self._log_buffer[(self._log_count - 1) % len(self._log_buffer)].copy()
+        finally:
+            self._log_lock.release()
+        if time.time() - sample['time'] > self._max_sample_age:
+            return None
+        return sample
         
-    def ramp_temperature(self, value, precision=0.015, timestep=20.0, timeout=1800):
+    def ramp_temperature(self, value, precision=0.015, timestep=None, timeout=None,
+                         window=60.0, detector=None, max_points=10000, plot=True):
         '''
         Ramps the temperature of the crysostat to a designated value and waits
-        untill the sensor temperature stabilizes. Minimum waiting time is 
-        (timestep)*15 seconds.
+        untill the sensor temperature stabilizes.
         
-        The temperature setpoint is sent to the ITC503, after which qtlab goes
+        The temperature setpoint is sent to the controller, after which qtlab goes
         into wait mode. Every (timestep) seconds, the measured temperature is 
-        checked and compared to the setpoint. The temperature is considered stable
-        when the mean error is smaller than (precision) over a period of 
-        (timestep)*15 seconds.
-        
-        Shorter timestep will result in shorter waiting times, however the
-        temperature might not be fully stabilized then.
+        passed to a StabilityDetector. The temperature is considered stable
+        when, over the last (window) seconds, the rms error is smaller than
+        (precision) and the temperature drifts by less than (precision) per
+        (window). The ramp returns as soon as this is the case.
         
         Input:
             value (float)                   :   Temperature to ramp to (Kelvin)
-            precision (float)               :   Mean temperature error allowed 
-                                                over a time period of timestep*15
-                                                seconds. Default is 15mK.
+            precision (float)               :   Rms temperature error allowed 
+                                                over the window. Default is 15mK.
             timestep (float)                :   time between each step in evaluating
                                                 the error while waiting. Default
-                                                is 20s, and taking 15 steps.
+                                                is 1/100 of the predicted settling
+                                                time (1 to 20s), or 5s without
+                                                a prediction.
             timeout (float)                 :   Maximum waiting time for the temperature
                                                 ramp. If waiting longer than <timeout>
                                                 seconds, the script will resume and the ramp
-                                                is regarded as completed.
+                                                is regarded as completed. Default is
+                                                3 times the predicted settling time
+                                                (at least 300s), or 1800s without a
+                                                prediction.
+            window (float)                  :   Time over which the temperature has
+                                                to be stable, in seconds. Default is 60s.
+            detector (StabilityDetector)    :   Use this detector instead of the
+                                                default one. precision and window
+                                                are then ignored.
+            max_points (int)                :   Maximum number of points kept for
+                                                the ramp log.
+            plot (bool)                     :   Render a plot of the ramp next to
+                                                the ramp log, in a background thread.
+                                                Default is True. Use plot_ramp to
+                                                plot a logged ramp later.
                                                 
         Output:
-            None
+            stable (bool)                   :   True if the temperature stabilized,
+                                                False if the ramp timed out.
+        '''
+        ramp = self._start_ramp(value, precision, timestep, timeout,
+                                window, detector, max_points)
+        if ramp is None:
+            return False
+        ramp.run(qt.msleep)
+        self.get_all()
+        print '\n%s: Sensor temperature %s' % (self.get_name(), ramp.message)
+        if plot and ramp.filename is not None:
+            worker = threading.Thread(target=self.plot_ramp, args=(ramp.filename,),
+                                      name='%s ramp plot' % self.get_name())
+            worker.daemon = True
+            worker.start()
+        return ramp.stable
+
+    def ramp_temperature_async(self, value, precision=0.015, timestep=None, timeout=None,
+                               window=60.0, detector=None, max_points=10000):
+        '''
+        Sets the temperature setpoint like ramp_temperature, but returns
+        immediately. The stability of the temperature is monitored in a
+        background thread, so other instruments can be used while the
+        temperature settles. Starting a new ramp cancels the previous one.
+
+        Input:
+            see ramp_temperature
+
+        Output:
+            ramp (RampHandle)   :   handle with done(), wait(), progress()
+                                    and cancel(). Returns False if the heater
+                                    is off and no valid range was selected.
         '''
-        output = '1'
-        channel = 'A'
+        ramp = self._start_ramp(value, precision, timestep, timeout,
+                                window, detector, max_points)
+        if ramp is None:
+            return False
+        ramp.start()
+        return ramp
+
+    def _start_ramp(self, value, precision, timestep, timeout, window,
+                    detector, max_points):
         name = self.get_name()
         if self.get_heater_range1() == 0:
             print '%s: Unable to perform ramp, heater_range1 is set to "off"!' % name
@@ -153,111 +668,560 @@ class Lakeshore_350(Instrument):
                 ans = int(ans)
             except:
                 print '%s: Invalid range, aborting ramp.' % name
-                return False
+                return None
             if ans in [1, 2, 3, 4, 5]:
                 self.set_heater_range1(ans)
                 print '%s: heater_range1 set to %i' % (name, ans)
             else:
                 print '%s: Invalid range, aborting ramp.' % name
-                return False
-                
+                return None
+
+        if self._ramp is not None:
+            self._ramp.cancel()
+        if timestep is None or timeout is None:
+            prediction = self.predict_settle_time(value, precision=precision, window=window)
+            if prediction is not None:
+                print '%s: Predicted settling time %d seconds.' % (name, int(prediction))
+            if timestep is None:
+                timestep = 5.0 if prediction is None else min(max(prediction/100.0, 1.0), 20.0)
+            if timeout is None:
+                timeout = 1800.0 if prediction is None else max(3*prediction, 300.0)
+        if detector is None:
+            detector = StabilityDetector(tolerance=precision, window=window)
+        detector.reset(value)
         self.set_setpoint1(value)
         print '%s: Ramp to %.2fK.' % (name, value)
+        self._ramp = RampHandle(self, value, detector, timestep, timeout, max_points)
+        return self._ramp
+
+    def predict_settle_time(self, value, start=None, precision=0.015, window=60.0):
+        '''
+        Predicts how long ramp_temperature takes to stabilize at a new
+        setpoint, from the ramps logged in the ramp log directory.
+
+        Each logged ramp is fitted with a first order plus dead time model,
+        T(t) = T0 + (T1 - T0)*(1 - exp(-(t - dead_time)/tau)). The dead time
+        and time constant for the new setpoint are averaged over the logged
+        ramps, weighted by how close their setpoints are on a log scale.
+        Ramps more than three region widths away hardly count; if there are
+        only such ramps, no prediction is made.
+
+        Input:
+            value (float)       :   Setpoint (Kelvin)
+            start (float)       :   Start temperature. Default is the
+                                    current temperature of input A.
+            precision (float)   :   Required precision, as in ramp_temperature.
+            window (float)      :   Stability window, as in ramp_temperature.
+
+        Output:
+            time (float)        :   Predicted settling time in seconds, or
+                                    None if no ramps near <value> have
+                                    been logged.
+        '''
+        fits = self._load_ramp_fits()
+        if len(fits) == 0:
+            return None
+        if start is None:
+            start = self.get_temperatureA()
+        distance = np.log(fits['target'] / value)
+        weights = np.exp(-0.5 * (distance / self._region_width)**2)
+        if np.max(weights) < np.exp(-0.5 * 3**2):
+            return None
+        dead_time = np.sum(weights * fits['dead_time']) / np.sum(weights)
+        tau = np.sum(weights * fits['tau']) / np.sum(weights)
+        step = max(abs(value - start), precision)
+        return dead_time + tau * np.log(step / precision) + window
+
+    def order_setpoints(self, setpoints, start=None, **kw):
+        '''
+        Orders temperature setpoints so the total predicted settling time
+        is small. Starting from the current temperature, the setpoint with
+        the shortest predicted settling time is taken next; setpoints without
+        a prediction come last, nearest first. Without logged ramps the
+        setpoints are sorted starting from the nearest end.
+
+        Input:
+            setpoints (list)    :   Setpoints in Kelvin.
+            start (float)       :   Start temperature. Default is the
+                                    current temperature of input A.
+            kw                  :   Passed on to predict_settle_time.
+
+        Output:
+            setpoints (list)    :   Ordered setpoints.
+        '''
+        if start is None:
+            start = self.get_temperatureA()
+        remaining = list(setpoints)
+        if len(self._load_ramp_fits()) == 0:
+            remaining.sort()
+            if abs(remaining[-1] - start) < abs(remaining[0] - start):
+                remaining.reverse()
+            return remaining
+        ordered = []
+        current = start
+        while remaining:
+            times = [self.predict_settle_time(T, current, **kw) for T in remaining]
+            if all(t is None for t in times):
+                times = [abs(T - current) for T in remaining]
+            else:
+                times = [np.inf if t is None else t for t in times]
+            current = remaining.pop(int(np.argmin(times)))
+            ordered.append(current)
+        return ordered
+
+    def _ramp_log_dir(self):
+        return os.path.join(os.path.abspath(qt.config['datadir']),
+                            'temperature_ramps', self.get_name())
+
+    def _log_ramp(self, ramp):
+        '''
+        Stores the trace of a finished ramp in the ramp log and adds its
+        fit to the settling time model.
+        '''
+        if len(ramp.times) < 2:
+            return
+        times = np.array(ramp.times)
+        temperatures = np.array(ramp.temperatures)
+        try:
+            directory = self._ramp_log_dir()
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            filename = self._reserve_ramp_log(directory, ramp.tstart)
+            try:
+                np.savez_compressed(filename, time=times.astype(np.float32),
+                                    temperature=temperatures.astype(np.float32),
+                                    heater_output=np.array(ramp.heaters, dtype=np.float32),
+                                    target=ramp.value, tstart=ramp.tstart,
+                                    stable=bool(ramp.stable))
+            except:
+                os.remove(filename)
+                raise
+            ramp.filename = filename
+        except (IOError, OSError), e:
+            logging.warning('%s: could not store ramp log: %s' % (self.get_name(), e))
+        fit = self._fit_ramp(times, temperatures, ramp.value)
+        if fit is not None and self._ramp_fits is not None:
+            self._ramp_fits = np.append(self._ramp_fits, np.array([fit], dtype=self._ramp_fits.dtype))
+
+    def _reserve_ramp_log(self, directory, tstart):
+        '''
+        Creates an empty ramp log named after the start time of the ramp and
+        returns its file name. Ramps started in the same second get a counter
+        suffix, so they do not overwrite each other.
+        '''
+        base = os.path.join(directory, 'temperature_ramp_' +
+            time.strftime('%Y%m%d_%H%M%S', time.localtime(tstart)))
+        filename = base + '.npz'
+        n = 0
+        while True:
+            try:
+                os.close(os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return filename
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            n += 1
+            filename = '%s_%03d.npz' % (base, n)
+
+    def _load_ramp_fits(self):
+        if self._ramp_fits is None:
+            fits = []
+            directory = self._ramp_log_dir()
+            if os.path.isdir(directory):
+                for filename in sorted(os.listdir(directory)):
+                    if not filename.endswith('.npz'):
+                        continue
+                    try:
+                        log = np.load(os.path.join(directory, filename))
+                        try:
+                            fit = self._fit_ramp(log['time'], log['temperature'], float(log['target']))
+                        finally:
+                            log.close()
+                    except (IOError, KeyError, ValueError), e:
+                        logging.warning('%s: skipping ramp log %s: %s' % (self.get_name(), filename, e))
+                        continue
+                    if fit is not None:
+                        fits.append(fit)
+            self._ramp_fits = np.array(fits, dtype=[('start', 'f8'), ('target', 'f8'),
+                                                    ('dead_time', 'f8'), ('tau', 'f8')])
+        return self._ramp_fits
+
+    def _fit_ramp(self, times, temperatures, target):
+        '''
+        Fits a first order plus dead time model to a ramp with the two point
+        method: tau = 1.5*(t63 - t28), dead_time = t63 - tau, where tXX is the
+        time at which XX% of the step is reached. Returns None if the step is
+        too small or the ramp did not reach 63%.
+        '''
+        start = float(temperatures[0])
+        step = target - start
+        if abs(step) < 1e-3:
+            return None
+        response = (np.asarray(temperatures, dtype=float) - start) / step
+        reached = np.nonzero(response >= 0.632)[0]
+        if len(reached) == 0:
+            return None
+        t63 = times[reached[0]]
+        t28 = times[np.nonzero(response >= 0.283)[0][0]]
+        tau = max(1.5 * (t63 - t28), 1e-3)
+        dead_time = max(t63 - tau, 0.0)
+        return (start, target, dead_time, tau)
+
+    def _read_ramp_sample(self):
+        '''
+        Returns the temperature of input A and the output of heater 1, from
+        the logger if it has a fresh sample and otherwise in one query.
+        '''
+        sample = self._fresh_sample()
+        if sample is not None:
+            return float(sample['temperatureA']), float(sample['heater_output1'])
+        T, heater = self._ask('KRDG? A;HTR? 1').split(';')
+        return float(T), float(heater)
+
+    def plot_ramp(self, filename=None):
+        '''
+        Plots a logged ramp and saves the plot as a png next to the log.
+        Uses the object oriented matplotlib interface, so it can run in a
+        background thread.
+
+        Input:
+            filename (string)   :   Ramp log (npz) to plot. Default is the
+                                    most recent ramp.
+
+        Output:
+            filename (string)   :   File name of the png, or None if no
+                                    filename is given and no ramps are logged.
+        '''
+        if filename is None:
+            directory = self._ramp_log_dir()
+            logs = []
+            if os.path.isdir(directory):
+                logs = sorted(f for f in os.listdir(directory) if f.endswith('.npz'))
+            if len(logs) == 0:
+                print '%s: No logged ramps to plot.' % self.get_name()
+                return None
+            filename = os.path.join(directory, logs[-1])
+        log = np.load(filename)
+        try:
+            tstart = float(log['tstart'])
+            times = log['time']
+            temperatures = log['temperature']
+            heaters = log['heater_output']
+        finally:
+            log.close()
+        plotname = 'temperature_ramp_'+ time.strftime('%Y%m%d_%H:%M:%S', time.localtime(tstart))
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        T = ax.plot(times, temperatures,'r', label='Temperature')
+        ax.set_xlabel('Time (seconds)', fontsize=16)
+        ax.set_ylabel('Temperature (Kelvin)', fontsize=16)
+        ax.set_title(plotname)
+        y_formatter = mpl.ticker.ScalarFormatter(useOffset=False)
+        ax.yaxis.set_major_formatter(y_formatter)
+        ax2 = ax.twinx()
+        H = ax2.plot(times, heaters, 'k', label='Heater out')
+        ax2.set_ylabel('Heater output (%)', fontsize=16)
+        ax.tick_params(axis='y', colors='red')
+        ax.yaxis.label.set_color('red')
+        pngname = os.path.splitext(filename)[0] + '.png'
+        fig.savefig(pngname, bbox_inches='tight')
+        return pngname
+
+    def sweep_temperature(self, start, stop, rate, interval=1.0, callback=None,
+                          ramp_to_start=True):
+        '''
+        Sweeps the temperature continuously from start to stop, using the
+        setpoint ramp of the controller. Every (interval) seconds the sensor
+        temperature, setpoint and heater output are sampled and passed to
+        callback, which can measure on the fly. The sweep ends when the
+        controller reports that the setpoint ramp is finished. The ramp rate
+        of output 1 is restored afterwards.
+
+        Input:
+            start (float)       :   Start temperature (Kelvin)
+            stop (float)        :   End temperature (Kelvin)
+            rate (float)        :   Sweep rate in K/min, 0.1 to 100.
+            interval (float)    :   Time between samples in seconds.
+            callback (function) :   Called as callback(sample) for every sample,
+                                    with sample a dict with keys time,
+                                    temperature, setpoint and heater_output.
+                                    It may return a float or a list of floats,
+                                    which is stored in the field value.
+            ramp_to_start (bool):   Stabilize at start with ramp_temperature
+                                    before sweeping. Default is True.
+
+        Output:
+            data (numpy array)  :   structured array with fields time,
+                                    temperature, setpoint, heater_output and,
+                                    with a callback, value.
+        '''
+        name = self.get_name()
+        old_rate = self.get_ramp_rate1()
+        if ramp_to_start:
+            self.set_ramp_rate1(0.0)
+            self.ramp_temperature(start)
+            if self.get_heater_range1() == 0:
+                self.set_ramp_rate1(old_rate)
+                return None
+
+        rows = []
+        values = []
+        try:
+            self.set_ramp_rate1(rate)
+            self.set_setpoint1(stop)
+            print '%s: Sweep to %.2fK at %.2fK/min.' % (name, stop, rate)
+            while True:
+                t = time.time()
+                T, setp, heater, ramping = self._ask('KRDG? A;SETP? 1;HTR? 1;RAMPST? 1').split(';')
+                sample = {'time': t, 'temperature': float(T),
+                          'setpoint': float(setp), 'heater_output': float(heater)}
+                rows.append((t, sample['temperature'], sample['setpoint'],
+                             sample['heater_output']))
+                if callback is not None:
+                    values.append(callback(sample))
+                if int(ramping) == 0:
+                    break
+                print '%s: Sweeping, T = %.3fK, setpoint %.3fK.\r' % (name, sample['temperature'], sample['setpoint']) ,
+                sys.stdout.flush()
+                qt.msleep(max(0.0, interval - (time.time() - t)))
+        finally:
+            self.set_ramp_rate1(old_rate)
+        print '\n%s: Sweep finished at %.2fK.' % (name, float(T))
+
+        dtype = [('time', 'f8'), ('temperature', 'f8'), ('setpoint', 'f8'),
+                 ('heater_output', 'f8')]
+        if callback is None:
+            return np.array(rows, dtype=dtype)
+        shape = np.shape(values[0])
+        data = np.zeros(len(rows), dtype=dtype + [('value', 'f8', shape)])
+        for field, column in zip(('time', 'temperature', 'setpoint', 'heater_output'),
+                                 zip(*rows)):
+            data[field] = column
+        data['value'] = values
+        return data
+
+    def bin_sweep(self, data, width, field='value'):
+        '''
+        Averages a field of sweep_temperature data in temperature bins.
+
+        Input:
+            data (numpy array)  :   output of sweep_temperature
+            width (float)       :   bin width in Kelvin
+            field (string)      :   field to average. Default is value.
+
+        Output:
+            bins (numpy array)  :   structured array with fields temperature
+                                    (mean sensor temperature in the bin),
+                                    <field> and <field>_std (mean and standard
+                                    deviation of the field) and count. Empty
+                                    bins are left out.
+        '''
+        T = data['temperature']
+        y = data[field].reshape(len(data), -1)
+        index = np.floor((T - T.min()) / width).astype(int)
+        count = np.bincount(index)
+        used = count > 0
+        n = count[used].astype(float)
+        mean_T = np.bincount(index, T)[used] / n
+        mean = np.empty((len(n), y.shape[1]))
+        std = np.empty((len(n), y.shape[1]))
+        for j in range(y.shape[1]):
+            sy = np.bincount(index, y[:, j])[used]
+            syy = np.bincount(index, y[:, j]**2)[used]
+            mean[:, j] = sy / n
+            std[:, j] = np.sqrt(np.maximum(syy / n - mean[:, j]**2, 0.0))
+        shape = data.dtype[field].shape
+        bins = np.zeros(len(n), dtype=[('temperature', 'f8'), (field, 'f8', shape),
+                                       (field + '_std', 'f8', shape), ('count', 'i8')])
+        bins['temperature'] = mean_T
+        bins[field] = mean.reshape((len(n),) + shape)
+        bins[field + '_std'] = std.reshape((len(n),) + shape)
+        bins['count'] = count[used]
+        return bins
+
+    def autotune(self, output='1', mode=2, timeout=600, interval=2.0):
+        '''
+        Runs the autotune of the controller at the current setpoint and
+        waits until it finishes. The temperature should be near the setpoint
+        before starting.
+
+        Input:
+            output (string)     :   Heater output to tune, '1' or '2'.
+            mode (int)          :   0: P only, 1: P and I, 2: P, I and D.
+            timeout (float)     :   Maximum time to wait in seconds.
+            interval (float)    :   Time between status queries in seconds.
+
+        Output:
+            pid (list)          :   New [P, I, D] values, or False if the
+                                    autotune failed or timed out. After a
+                                    timeout the controller may still be
+                                    tuning and change the PID values when
+                                    it finishes; check TUNEST? or set the
+                                    PID values again.
+        '''
+        name = self.get_name()
+        self._write('ATUNE %s,%d' % (output, mode))
+        print '%s: Autotuning output %s.' % (name, output)
         tstart = time.time()
-        number_of_points = 15
-        errors = []
-        temperatures = [self.get_temperatureA()]
-        times = [0]
-        heaters = [self.get_heater_output1()]
-        qt.msleep(timestep)
-        
-        for i in np.arange(0,number_of_points):
-            T = self.get_temperatureA()
-            errors.append( np.abs(value - T) )
-            temperatures.append(T)
-            heaters.append(self.get_heater_output1())
-            times.append(time.time()-tstart)
-            qt.msleep(timestep)
-            
-        msg1 = 'stabilized at'
-        msg2 = ' after %d seconds.' % int(time.time()-tstart)
-        timeout_achieved = False
-        
-        while np.mean(errors[-number_of_points:]) > precision and not timeout_achieved:
-            T = self.get_temperatureA()
-            error = np.abs(value - T)
-            heaters.append(self.get_heater_output1())
-            temperatures.append(T)
-            errors.append(error)
-            times.append(time.time()-tstart)
-            meanerror = np.mean(errors[-number_of_points:])
-            
-            print '%s: Awaiting stable Temp. Mean error: %3.3fK. Required: %1.2fK.\r' % (name, meanerror, precision) ,
-            sys.stdout.flush()
-            qt.msleep(timestep)
-            msg1 = 'stabilized at'
-            msg2 = ' after %d seconds.' % int(time.time()-tstart)
-            
-            if time.time() > (tstart+timeout):
-                timeout_achieved = True
-                print '\n%s: Ramping for %.1f seconds total. Maximum waiting time achieved. Script operation resumed.' % (name, int(time.time()-tstart))
-                msg1 = 'after ramp at'
-                msg2 = ', current error %.3fK.' % error
-        self.get_all()
-        print '\n%s: Sensor temperature %s %2.2fK%s' % (name, msg1, self.get_temperatureA(), msg2)
-        
-        plot = True
-        if plot:
-            plotname = 'temperature_ramp_'+ time.strftime('%Y%m%d_%H:%M:%S', time.localtime(tstart))
-            fig = plt.figure()
-            ax = fig.add_subplot(111)
-            T = ax.plot(times, temperatures,'r', label='Temperature')
-            ax.set_xlabel('Time (seconds)', fontsize=16)
-            ax.set_ylabel('Temperature (Kelvin)', fontsize=16)
-            ax.set_title(plotname)
-            y_formatter = mpl.ticker.ScalarFormatter(useOffset=False)
-            ax.yaxis.set_major_formatter(y_formatter)
-            ax2 = ax.twinx()
-            H = ax2.plot(times, heaters, 'k', label='Heater out')
-            ax2.set_ylabel('Heater output (%)', fontsize=16)
-            ax.tick_params(axis='y', colors='red')
-            ax.yaxis.label.set_color('red')
-            filename = os.path.abspath(qt.config['datadir'])+'\\'+'temperature_ramp_'+ time.strftime('%Y%m%d_%H%M%S', time.localtime(tstart))+'.png'
-            pylab.savefig(filename,bbox_inches='tight')
-            fig.clear()
-            
+        while True:
+            qt.msleep(interval)
+            tuning, tune_output, error, stage = self._ask('TUNEST?').split(',')
+            if int(error):
+                print '%s: Autotune failed in stage %s.' % (name, stage)
+                return False
+            if not int(tuning):
+                break
+            if time.time() > tstart + timeout:
+                print '%s: Autotune did not finish within %d seconds.' % (name, timeout)
+                return False
+            logging.debug('%s: autotune stage %s' % (name, stage))
+        pid = self.get('pid' + output)
+        print '%s: Autotune finished, P=%.1f I=%.1f D=%.1f.' % (name, pid[0], pid[1], pid[2])
+        return pid
+
+    def get_zones(self, output='1'):
+        '''
+        Reads the zone table of an output.
+
+        Input:
+            output (string)     :   Heater output, '1' or '2'.
+
+        Output:
+            zones (list)        :   10 dicts with keys upper, p, i, d,
+                                    manual_output, heater_range, input and
+                                    rate.
+        '''
+        ans = self._ask_many(['ZONE? %s,%d' % (output, z) for z in range(1, 11)])
+        return [self._parse_zone(a) for a in ans]
+
+    def _parse_zone(self, ans):
+        fields = ans.split(',')
+        return {'upper': float(fields[0]),
+                'p': float(fields[1]),
+                'i': float(fields[2]),
+                'd': float(fields[3]),
+                'manual_output': float(fields[4]),
+                'heater_range': int(fields[5]),
+                'input': int(fields[6]),
+                'rate': float(fields[7])}
+
+    def set_zones(self, zones, output='1', zone_mode=True):
+        '''
+        Loads a zone table. In zone mode the controller switches PID values
+        and heater range whenever the setpoint crosses a zone boundary.
+
+        Input:
+            zones (list)        :   Up to 10 dicts, ordered by upper bound,
+                                    with keys upper, p, i, d and heater_range.
+                                    Optional keys are manual_output (%),
+                                    input (0 for the control input, 1-4 for
+                                    A-D) and rate (K/min). Zones that are not
+                                    given are cleared.
+            output (string)     :   Heater output, '1' or '2'.
+            zone_mode (bool)    :   Switch the output to zone mode.
+
+        Output:
+            None
+        '''
+        if len(zones) > 10:
+            raise ValueError('The controller has at most 10 zones')
+        for z in range(10):
+            if z < len(zones):
+                zone = zones[z]
+                self._write('ZONE %s,%d,%.3f,%.1f,%.1f,%.1f,%.1f,%d,%d,%.1f' % (output, z+1,
+                    zone['upper'], zone['p'], zone['i'], zone['d'],
+                    zone.get('manual_output', 0.0), zone['heater_range'],
+                    zone.get('input', 0), zone.get('rate', 0.0)))
+            else:
+                self._write('ZONE %s,%d,0,0,0,0,0,0,0,0' % (output, z+1))
+        if zone_mode:
+            self.set('zone_mode' + output, True)
+
+    def tune_zones(self, bounds, heater_ranges, output='1', mode=2, **kw):
+        '''
+        Builds a zone table by autotuning in every zone. For each zone the
+        temperature is ramped to the middle of the zone with
+        ramp_temperature, the controller is autotuned, and the tuned PID
+        values are stored. The table is then loaded and zone mode enabled.
+        If a ramp does not stabilize, the tuning stops without autotuning
+        in that zone and the zone table is left unchanged.
+
+        Input:
+            bounds (list)       :   Upper bounds of the zones in Kelvin,
+                                    in increasing order.
+            heater_ranges (list):   Heater range (1 to 5) for each zone.
+            output (string)     :   Heater output, '1' or '2'.
+            mode (int)          :   Autotune mode, see autotune.
+            kw                  :   Passed on to ramp_temperature.
+
+        Output:
+            zones (list)        :   The zone table that was loaded, or False
+                                    if a ramp or an autotune failed.
+        '''
+        if output != '1':
+            raise ValueError('tune_zones ramps with output 1 only')
+        self.set('zone_mode' + output, False)
+        zones = []
+        lower = 0.0
+        for upper, heater_range in zip(bounds, heater_ranges):
+            self.set('heater_range' + output, heater_range)
+            if not self.ramp_temperature((lower + upper) / 2.0, **kw):
+                print '%s: Ramp to zone %d did not stabilize, tuning stopped.' % (
+                    self.get_name(), len(zones) + 1)
+                return False
+            pid = self.autotune(output, mode)
+            if pid is False:
+                return False
+            zones.append({'upper': upper, 'p': pid[0], 'i': pid[1], 'd': pid[2],
+                          'heater_range': heater_range})
+            lower = upper
+        self.set_zones(zones, output)
+        return zones
+
     # ------------------------------------------------------
     # ------------ Get and Set parameters ------------------
     # ------------------------------------------------------
         
     def do_get_temperature(self, channel):
-        ans = self._visa.ask('KRDG? %s' % channel)
+        sample = self._fresh_sample()
+        if sample is not None:
+            return float(sample['temperature' + channel])
+        ans = self._ask('KRDG? %s' % channel)
         return float(ans)
         
     def do_get_sensor_resistance(self, channel):
-        ans = self._visa.ask('SRDG? %s' % channel)
+        sample = self._fresh_sample()
+        if sample is not None:
+            return float(sample['sensor_resistance' + channel])
+        ans = self._ask('SRDG? %s' % channel)
         return float(ans)
         
     def do_get_heater_range(self, channel):
-        ans = self._visa.ask('RANGE? %s' % channel)
+        ans = self._ask('RANGE? %s' % channel)
         return ans
         
     def do_set_heater_range(self, val, channel):
-        # First turn heater on
-        self._visa.write('OUTMODE %s, 1, %s, 0' % (channel, channel) )
+        # First turn heater on, unless it is already in closed loop or
+        # zone mode
+        if self._parse_outmode(self._ask('OUTMODE? %s' % channel))[0] not in (1, 2):
+            self._write('OUTMODE %s, 1, %s, 0' % (channel, channel) )
         # Then set range to correct value
-        self._visa.write('RANGE %s,%d' % (channel, val))
+        self._write('RANGE %s,%d' % (channel, val))
         
     def do_get_heater_output(self, channel):
-        ans = self._visa.ask('HTR? %s' % channel)
+        sample = self._fresh_sample()
+        if sample is not None:
+            return float(sample['heater_output' + channel])
+        ans = self._ask('HTR? %s' % channel)
         return ans
         
     def do_get_mode(self):
-        ans = self._visa.ask('MODE?')
+        ans = self._ask('MODE?')
         return int(ans)
 
     def do_set_mode(self, mode):
-        self._visa.write('MODE %d' % mode)
+        self._write('MODE %d' % mode)
 
     def local(self):
         self.set_mode(1)
@@ -266,7 +1230,10 @@ class Lakeshore_350(Instrument):
         self.set_mode(2)
 
     def do_get_pid(self, channel):
-        ans = self._visa.ask('PID? %s' % channel)
+        ans = self._ask('PID? %s' % channel)
+        return self._parse_pid(ans)
+
+    def _parse_pid(self, ans):
         fields = ans.split(',')
         if len(fields) != 3:
             return None
@@ -274,13 +1241,62 @@ class Lakeshore_350(Instrument):
         return fields
         
     def do_set_pid(self, val, channel):
-        print '%s: Setting pid values not implemented.' % self.get_name()
-        return False
+        if len(val) != 3:
+            raise ValueError('pid should be a list [P, I, D]')
+        self._write('PID %s,%f,%f,%f' % (channel, val[0], val[1], val[2]))
         
     def do_get_setpoint(self, channel):
-        ans = self._visa.ask('SETP? %s' % channel)
+        ans = self._ask('SETP? %s' % channel)
         return float(ans)
         
     def do_set_setpoint(self, val, channel):
-        self._visa.write('SETP %s,%f' % (channel,val))
-        
\ No newline at end of file
+        self._write('SETP %s,%f' % (channel,val))
+
+    def do_get_log_interval(self):
+        return self._log_interval
+
+    def do_set_log_interval(self, val):
+        self._log_interval = val
+
+    def do_get_max_sample_age(self):
+        return self._max_sample_age
+
+    def do_set_max_sample_age(self, val):
+        self._max_sample_age = val
+
+    def do_get_ramp_rate(self, channel):
+        ans = self._ask('RAMP? %s' % channel)
+        return self._parse_ramp(ans)
+
+    def _parse_ramp(self, ans):
+        # Reply is <off/on>,<rate>; a rate of 0 means ramping is off
+        on, rate = ans.split(',')
+        if int(on) == 0:
+            return 0.0
+        return float(rate)
+
+    def do_set_ramp_rate(self, val, channel):
+        if val > 0:
+            self._write('RAMP %s,1,%f' % (channel, val))
+        else:
+            self._write('RAMP %s,0,0' % channel)
+
+    def do_get_ramp_status(self, channel):
+        ans = self._ask('RAMPST? %s' % channel)
+        return int(ans)
+
+    def do_get_zone_mode(self, channel):
+        ans = self._ask('OUTMODE? %s' % channel)
+        return self._parse_outmode(ans)[0] == 2
+
+    def do_set_zone_mode(self, val, channel):
+        mode, inp, powerup = self._parse_outmode(self._ask('OUTMODE? %s' % channel))
+        if val:
+            mode = 2
+        elif mode == 2:
+            mode = 1
+        self._write('OUTMODE %s,%d,%d,%d' % (channel, mode, inp, powerup))
+
+    def _parse_outmode(self, ans):
+        # Reply is <mode>,<input>,<powerup enable>
+        return [int(f) for f in ans.split(',')]